@@ -1,8 +1,19 @@
 from datasette import hookimpl
-from dogsheep_beta.utils import parse_metadata
+from datasette.database import Database
+from dogsheep_beta.cache import get_cache
+from dogsheep_beta.config import load_config
+from dogsheep_beta.timing import start_request, stats, timed
+from dogsheep_beta.utils import DAY_SQL, get_generation, partition_tables
+from markupsafe import Markup
+import asyncio
+import base64
+import datetime
 import html
+import os
+import re
+import threading
+import time
 import urllib
-from jinja2 import Template
 import json
 
 TIMELINE_SQL = """
@@ -12,40 +23,167 @@ select
   search_index.key,
   search_index.title,
   search_index.category,
-  search_index.timestamp,
-  search_index.search_1
+  search_index.timestamp{extra_columns}
 from
   search_index
 {where}
   {where_clauses}
 order by
   {order_by}
-limit 40
+limit :limit
 """
 
 SEARCH_SQL = """
 select
-  search_index_fts.rank,
+  {rank} as rank,
   search_index.rowid,
   search_index.type,
   search_index.key,
   search_index.title,
   search_index.category,
-  search_index.timestamp,
-  search_index.search_1
+  search_index.timestamp{extra_columns}
 from
-  search_index join search_index_fts on search_index.rowid = search_index_fts.rowid
+  {from_}
 {where}
   {where_clauses}
 order by
   {order_by}
-limit 100
+limit :limit
 """
+
+SEARCH_FROM = "search_index join [{fts}] on search_index.rowid = [{fts}].rowid"
+
+COMPLETIONS_SQL = """
+select term, documents from search_index_terms
+where term >= :prefix and term < :prefix_end
+order by documents desc, term
+limit :size
+"""
+
+SUGGEST_TITLES_SQL = """
+select
+  search_index.type,
+  search_index.key,
+  search_index.title
+from
+  {from_}
+where
+  {where_clauses}
+order by
+  {rank}
+limit :size
+"""
+
+FACET_SQL = """
+with matches as (
+  {matches}
+)
+select 'count' as facet, null as value, null as label, {total} as count from matches
+union all
+select * from (
+  select 'type', type, type, {count} from matches
+  where type is not null
+  group by type order by {count} desc, type limit :facet_size
+)
+union all
+select * from (
+  select 'category', matches.category, coalesce(categories.name, matches.category), {count}
+  from matches left join categories on matches.category = categories.id
+  where matches.category is not null
+  group by matches.category order by {count} desc, matches.category limit :facet_size
+)
+union all
+select * from (
+  select 'is_public', is_public, is_public, {count} from matches
+  where is_public is not null
+  group by is_public order by {count} desc, is_public limit :facet_size
+)
+union all
+select * from (
+  select 'timestamp', day, day, {count} from matches
+  where day is not null
+  group by day order by {count} desc, day limit :facet_size
+)
+"""
+
+FACET_MATCHES_SQL = """select
+    search_index.type,
+    search_index.category,
+    search_index.is_public,
+    {day} as day
+  from
+    {{from_}}
+  {{where}}
+    {{where_clauses}}""".format(
+    day=DAY_SQL.format("search_index")
+)
+
+# Used when there is no search term - one row per type, category, is_public
+# and day, with the number of items in that group as n
+SUMMARY_MATCHES_SQL = """select
+    type, category, is_public, day, count as n
+  from
+    search_index_summary
+  {where}
+    {where_clauses}"""
+
 FILTER_COLS = ("type", "category", "is_public")
+# Facet name => the querystring argument used to filter by it
+FACET_NAMES = {
+    "type": "type",
+    "category": "category",
+    "is_public": "is_public",
+    "timestamp": "timestamp__date",
+}
+# Arguments that restrict the timestamp to a range
+DATE_ARGS = (
+    "timestamp__date",
+    "timestamp__month",
+    "timestamp__year",
+    "timestamp__gte",
+    "timestamp__lt",
+)
+# Arguments preserved by facet toggle links, in order
+FACET_ARGS = DATE_ARGS + FILTER_COLS
+# Sort orders are lists of (expression, result column, descending) - they
+# always end in rowid so they can be used for keyset pagination
 SORT_ORDERS = {
-    "oldest": "search_index.timestamp",
-    "newest": "search_index.timestamp desc",
+    "oldest": [
+        ("search_index.timestamp", "timestamp", False),
+        ("search_index.rowid", "rowid", False),
+    ],
+    "newest": [
+        ("search_index.timestamp", "timestamp", True),
+        ("search_index.rowid", "rowid", True),
+    ],
 }
+# {fts} is replaced by the name of the full-text table, which differs for
+# each partition if the index is partitioned by year
+DEFAULT_RANK = "[{fts}].rank"
+FTS_TABLE = "search_index_fts"
+# Matches are wrapped in these characters by SQLite, then replaced with the
+# snippet_markers after the rest of the text has been HTML escaped
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+SNIPPET_TOKENS = 15
+SNIPPET_MARKERS = ("<mark>", "</mark>")
+TIMELINE_PAGE_SIZE = 40
+SEARCH_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 100
+SUGGEST_SIZE = 10
+# Suggestions are requested on every keystroke, so any query that takes
+# longer than this is abandoned
+SUGGEST_TIME_LIMIT_MS = 50
+# Matches the default number of Datasette SQL threads
+DISPLAY_CONCURRENCY = 3
+CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# Database path => (generation, index_layout() for that generation)
+_index_layouts = {}
+# Database path => inode of the index file the plugin last saw there
+_index_inodes = {}
+# Seconds to let queries against a replaced index file finish before closing it
+REOPEN_CLOSE_DELAY = 10
 
 
 class InnerResponseError(Exception):
@@ -54,14 +192,249 @@ class InnerResponseError(Exception):
 
 async def beta(request, datasette):
     from datasette.utils.asgi import Response
-    from datasette.utils import path_with_removed_args, path_with_replaced_args
 
+    timer = start_request()
+    context = await beta_context(request, datasette)
+    with timed("template"):
+        rendered = await datasette.render_template(
+            "beta.html", context, request=request
+        )
+    response = Response.html(rendered)
+    response.headers["Server-Timing"] = timer.server_timing()
+    return response
+
+
+async def beta_json(request, datasette):
+    # Same as /-/beta, with ?_output=1 to include the rendered HTML
+    from datasette.utils.asgi import Response
+
+    timer = start_request()
+    render = bool(request.args.get("_output"))
+    context = await beta_context(request, datasette, render=render, api=True)
+    response = Response.json(
+        {
+            key: context[key]
+            for key in ("q", "count", "facets", "results", "next", "next_url")
+        },
+        default=repr,
+    )
+    response.headers["Server-Timing"] = timer.server_timing()
+    return response
+
+
+async def beta_stats(request, datasette):
+    # Recent timings for each stage of handling a request, in milliseconds
+    from datasette.utils.asgi import Response
+
+    return Response.json(stats.summary())
+
+
+async def beta_ndjson(request, datasette):
+    # Streams every matching row, one JSON object per line, fetching them
+    # from SQLite a page at a time so memory use stays bounded
+    from datasette.utils.asgi import AsgiStream
+
+    start_request()
+    settings = await search_settings(request, datasette, api=True)
+    render = bool(request.args.get("_output"))
+
+    async def fetch_page(next_token):
+        results, next_token = await search(
+            datasette,
+            settings["database_name"],
+            request,
+            settings["max_page_size"],
+            settings["rank"],
+            settings["include_search_1"],
+            settings["snippet_options"],
+            next_token=next_token,
+            size=page_size(request.args, True, settings["max_page_size"]),
+            partitions=settings["partitions"],
+        )
+        if render:
+            await process_results(
+                datasette,
+                results,
+                settings["beta_config"],
+                settings["q"],
+                settings["template_debug"],
+                settings["display_concurrency"],
+                settings["fragment_cache"],
+                settings["generation"],
+            )
+        return results, next_token
+
+    # The first page is fetched before the response starts, so that invalid
+    # arguments still result in a 400 error
+    first_page = await fetch_page(request.args.get("next"))
+
+    async def stream(writer):
+        results, next_token = first_page
+        while True:
+            for result in results:
+                await writer.write(json.dumps(result, default=repr) + "\n")
+            if not next_token:
+                break
+            results, next_token = await fetch_page(next_token)
+
+    return AsgiStream(stream, content_type="application/x-ndjson; charset=utf-8")
+
+
+async def beta_suggest(request, datasette):
+    # Completions for the last word of ?q=, plus the titles of the best
+    # matching items, for search-as-you-type
+    from datasette.database import QueryInterrupted
+    from datasette.utils.asgi import Response
+
+    timer = start_request()
+    settings = await search_settings(request, datasette, api=True)
+    database = settings["database"]
+    time_limit = (
+        settings["config"].get("suggest_time_limit_ms") or SUGGEST_TIME_LIMIT_MS
+    )
+    size = page_size(request.args, True, SUGGEST_SIZE)
+    q = request.args.get("q") or ""
+    words = re.findall(r"\w+", q.lower())
+    # The last word is still being typed, unless it is followed by a space
+    prefix = words.pop() if words and not q[-1].isspace() else ""
+    partitions = settings["partitions"]
+    completions = []
+    titles = []
+    timed_out = False
+    # The time limit is shared by all of the queries
+    deadline = time.perf_counter() + time_limit / 1000
+    with timed("suggest"):
+        try:
+            if prefix and settings["terms"]:
+                results = await database.execute(
+                    COMPLETIONS_SQL,
+                    {
+                        "prefix": prefix,
+                        "prefix_end": prefix[:-1] + chr(ord(prefix[-1]) + 1),
+                        "size": size,
+                    },
+                    custom_time_limit=time_limit,
+                )
+                completions = [
+                    {
+                        "term": row["term"],
+                        "documents": row["documents"],
+                        "q": " ".join(words + [row["term"]]),
+                    }
+                    for row in results.rows
+                ]
+            if words or prefix:
+                phrases = ['"{}"'.format(word) for word in words]
+                if prefix:
+                    # With stemming, a partly typed word may not be a prefix
+                    # of its own stem - so match the completions as well
+                    alternatives = ['"{}"*'.format(prefix)] + [
+                        '"{}"'.format(completion["term"])
+                        for completion in completions
+                    ]
+                    phrases.append("({})".format(" OR ".join(alternatives)))
+                query = " AND ".join(phrases)
+                # Newest partitions first, as they are searched by relevance
+                # one at a time rather than merged
+                for fts in (
+                    partitions_for(partitions, request.args)
+                    if partitions
+                    else [FTS_TABLE]
+                ):
+                    remaining = int((deadline - time.perf_counter()) * 1000)
+                    # A limit of 0 would mean Datasette's default instead
+                    if remaining < 1:
+                        timed_out = True
+                        break
+                    where_clauses, params = search_filters(request.args, query, fts)
+                    results = await database.execute(
+                        SUGGEST_TITLES_SQL.format(
+                            from_=SEARCH_FROM.format(fts=fts),
+                            where_clauses=" and ".join(where_clauses),
+                            rank=settings["rank"].format(fts=fts),
+                        ),
+                        dict(params, size=size - len(titles)),
+                        custom_time_limit=remaining,
+                    )
+                    titles.extend(dict(row) for row in results.rows)
+                    if len(titles) >= size:
+                        break
+        except QueryInterrupted:
+            timed_out = True
+    response = Response.json(
+        {
+            "q": q,
+            "completions": completions,
+            "titles": titles,
+            "timed_out": timed_out,
+        },
+        default=repr,
+    )
+    response.headers["Server-Timing"] = timer.server_timing()
+    return response
+
+
+async def search_settings(request, datasette, api=False):
+    # Plugin configuration plus details of the index needed to run a search
     config = datasette.plugin_config("dogsheep-beta") or {}
     database_name = config.get("database") or datasette.get_database().name
-    dogsheep_beta_config_file = config["config_file"]
-    template_debug = bool(config.get("template_debug"))
-    rules = parse_metadata(open(dogsheep_beta_config_file).read())
-    q = (request.args.get("q") or "").strip()
+    beta_config = load_config(config["config_file"])
+    database = reopen_if_replaced(datasette, datasette.get_database(database_name))
+    generation = await index_generation(database)
+    layout = await index_layout(database, generation)
+    fts_column_names = layout["fts_columns"]
+    cache_max_bytes = config.get("cache_max_bytes", CACHE_MAX_BYTES)
+    return {
+        "config": config,
+        "database_name": database_name,
+        "database": database,
+        "beta_config": beta_config,
+        "q": (request.args.get("q") or "").strip(),
+        "generation": generation,
+        "template_debug": bool(config.get("template_debug")),
+        "display_concurrency": config.get("display_concurrency")
+        or DISPLAY_CONCURRENCY,
+        "facet_engine": config.get("facet_engine") or "sql",
+        "cache_max_bytes": cache_max_bytes,
+        "max_page_size": config.get("max_page_size") or MAX_PAGE_SIZE,
+        "rank": rank_expression(fts_column_names, config.get("bm25_weights")),
+        "snippet_options": {
+            "tokens": config.get("snippet_tokens") or SNIPPET_TOKENS,
+            "markers": config.get("snippet_markers") or SNIPPET_MARKERS,
+            "highlight_column": fts_column_names.index("title")
+            if "title" in fts_column_names
+            else None,
+        },
+        # Leave out the potentially large search_1 column unless it is used -
+        # API callers get it regardless as they may not use the templates
+        "include_search_1": api or beta_config.uses_search_1,
+        "partitions": layout["partitions"],
+        "summary": layout["summary"],
+        "terms": layout["terms"],
+        # Rendered output for individual items, shared between result pages
+        "fragment_cache": get_cache(
+            "fragments", cache_max_bytes, config.get("cache_file")
+        )
+        if cache_max_bytes
+        else None,
+    }
+
+
+async def beta_context(request, datasette, render=True, api=False):
+    from datasette.utils import path_with_removed_args, path_with_replaced_args
+
+    settings = await search_settings(request, datasette, api)
+    config = settings["config"]
+    database_name = settings["database_name"]
+    database = settings["database"]
+    beta_config = settings["beta_config"]
+    generation = settings["generation"]
+    facet_engine = settings["facet_engine"]
+    max_page_size = settings["max_page_size"]
+    rank = settings["rank"]
+    snippet_options = settings["snippet_options"]
+    include_search_1 = settings["include_search_1"]
+    q = settings["q"]
     sorted_by = "relevance" if q else "newest"
     if request.args.get("sort") in SORT_ORDERS:
         sorted_by = request.args["sort"]
@@ -73,111 +446,600 @@ async def beta(request, datasette):
             other_sort_orders.append(
                 {
                     "label": sort_order,
-                    "url": path_with_replaced_args(request, {"sort": sort_order})
+                    "url": path_with_replaced_args(
+                        request, {"sort": sort_order, "next": None}
+                    )
                     if sort_order != "relevance"
-                    else path_with_removed_args(request, {"sort"}),
+                    else path_with_removed_args(request, {"sort", "next"}),
                 }
             )
     results = []
     facets = {}
     count = None
 
-    results = await search(datasette, database_name, request)
-    count, facets = await get_count_and_facets(datasette, database_name, request)
-    await process_results(datasette, results, rules, q, template_debug)
+    result_cache = None
+    if settings["cache_max_bytes"]:
+        result_cache = get_cache(
+            "results", settings["cache_max_bytes"], config.get("cache_file")
+        )
+        cache_key = [
+            database.path,
+            facet_engine,
+            rank,
+            max_page_size,
+            snippet_options,
+            include_search_1,
+            sorted(urllib.parse.parse_qsl(request.query_string)),
+        ]
+        cached = result_cache.get(generation, cache_key)
+    if result_cache is not None and cached is not None:
+        results, next_token = cached["results"], cached["next"]
+        count, facets = cached["count"], cached["facets"]
+    else:
+        # The search and the count/facets do not depend on each other
+        (results, next_token), (count, facets) = await asyncio.gather(
+            timed_call(
+                "search",
+                search(
+                    datasette,
+                    database_name,
+                    request,
+                    max_page_size,
+                    rank,
+                    include_search_1,
+                    snippet_options,
+                    partitions=settings["partitions"],
+                ),
+            ),
+            timed_call(
+                "facets",
+                get_count_and_facets(
+                    datasette,
+                    database_name,
+                    request,
+                    facet_engine,
+                    settings["partitions"],
+                    settings["summary"],
+                ),
+            ),
+        )
+        facets = list(facets)
+        if result_cache is not None:
+            result_cache.set(
+                generation,
+                cache_key,
+                {
+                    "results": results,
+                    "next": next_token,
+                    "count": count,
+                    "facets": facets,
+                },
+            )
+    if render:
+        await process_results(
+            datasette,
+            results,
+            beta_config,
+            q,
+            settings["template_debug"],
+            settings["display_concurrency"],
+            settings["fragment_cache"],
+            generation,
+        )
 
     hiddens = [
         {"name": column, "value": request.args[column]}
-        for column in FILTER_COLS
+        for column in DATE_ARGS + FILTER_COLS
         if column in request.args
     ]
-    return Response.html(
-        await datasette.render_template(
-            "beta.html",
+    return {
+        "q": q or "",
+        "count": count,
+        "results": results,
+        "facets": facets,
+        "hiddens": hiddens,
+        "sorted_by": sorted_by,
+        "other_sort_orders": other_sort_orders,
+        "autocomplete": settings["terms"],
+        "next": next_token,
+        "next_url": path_with_replaced_args(request, {"next": next_token})
+        if next_token
+        else None,
+    }
+
+
+class ReopenedDatabase(Database):
+    # Datasette keeps a connection per thread for each database name, which
+    # would hand this database connections to the file it replaced
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._connections = threading.local()
+
+    async def execute_fn(self, fn):
+        if self.ds.executor is None:
+            return await super().execute_fn(fn)
+
+        def in_thread():
+            conn = getattr(self._connections, "conn", None)
+            if conn is None:
+                conn = self.connect()
+                self.ds._prepare_connection(conn, self.name)
+                self._connections.conn = conn
+            return fn(conn)
+
+        return await asyncio.get_event_loop().run_in_executor(
+            self.ds.executor, in_thread
+        )
+
+
+def reopen_if_replaced(datasette, database):
+    # dogsheep-beta index --swap renames a new index file into place, but open
+    # connections carry on reading the old one - so when the file has a new
+    # inode, replace the database with one that opens new connections
+    if not database.path:
+        return database
+    try:
+        inode = os.stat(database.path).st_ino
+    except FileNotFoundError:
+        return database
+    previous = _index_inodes.setdefault(database.path, inode)
+    if inode == previous:
+        return database
+    _index_inodes[database.path] = inode
+    reopened = ReopenedDatabase(
+        datasette, path=database.path, is_mutable=database.is_mutable
+    )
+    name, route = database.name, database.route
+    datasette.remove_database(name)
+    datasette.add_database(reopened, name=name, route=route)
+    asyncio.get_event_loop().call_later(REOPEN_CLOSE_DELAY, database.close)
+    return reopened
+
+
+async def timed_call(stage, awaitable):
+    with timed(stage):
+        return await awaitable
+
+
+async def index_generation(database):
+    # Changes every time the indexer runs against this database
+    from datasette.utils import sqlite3
+
+    def read_generation(conn):
+        try:
+            return get_generation(conn)
+        except sqlite3.OperationalError:
+            # Index created by an older version, use the file mtime instead
+            return os.stat(database.path).st_mtime_ns if database.path else None
+
+    return await database.execute_fn(read_generation)
+
+
+async def index_layout(database, generation):
+    # The full-text columns, plus {year: table} if the index is partitioned.
+    # Cached, as these only change when the indexer runs
+    cached = _index_layouts.get(database.path)
+    if cached is None or cached[0] != generation:
+        partitions = await database.execute_fn(partition_tables)
+        fts_table = next(iter(partitions.values())) if partitions else FTS_TABLE
+        results = await database.execute(
+            "select name from pragma_table_info(?)", [fts_table]
+        )
+        tables = await database.execute(
+            "select name from sqlite_master where name in "
+            "('search_index_summary', 'search_index_terms')"
+        )
+        table_names = {row[0] for row in tables.rows}
+        cached = (
+            generation,
             {
-                "q": q or "",
-                "count": count,
-                "results": results,
-                "facets": facets,
-                "hiddens": hiddens,
-                "sorted_by": sorted_by,
-                "other_sort_orders": other_sort_orders,
+                "fts_columns": [row[0] for row in results.rows],
+                "partitions": partitions,
+                # Indexes created by older versions do not have this table
+                "summary": "search_index_summary" in table_names,
+                # Only created by dogsheep-beta index --autocomplete
+                "terms": "search_index_terms" in table_names,
             },
-            request=request,
         )
+        _index_layouts[database.path] = cached
+    return cached[1]
+
+
+def rank_expression(fts_column_names, weights=None):
+    # Relevance is calculated using bm25() if weights have been configured
+    if not weights:
+        return DEFAULT_RANK
+    # bm25() takes a weight for each column, in the order they are defined
+    return "bm25([{{fts}}], {})".format(
+        ", ".join(str(float(weights.get(column, 1))) for column in fts_column_names)
     )
 
 
-async def search(datasette, database_name, request):
-    from datasette.utils import sqlite3, escape_fts
+def relevance_order(rank=DEFAULT_RANK):
+    return [
+        (rank, "rank", False),
+        ("search_index.timestamp", "timestamp", True),
+        ("search_index.rowid", "rowid", False),
+    ]
+
 
+async def search(
+    datasette,
+    database_name,
+    request,
+    max_page_size=MAX_PAGE_SIZE,
+    rank=DEFAULT_RANK,
+    include_search_1=True,
+    snippet_options=None,
+    next_token=None,
+    size=None,
+    partitions=None,
+):
+    # Returns (results, next_token) for a page of results, starting after
+    # next_token (defaults to the ?next= argument). partitions is the
+    # {year: table} of a partitioned index
     database = datasette.get_database(database_name)
     q = (request.args.get("q") or "").strip()
-
+    snippet_options = snippet_options or {}
+    markers = snippet_options.get("markers") or SNIPPET_MARKERS
+    extra_columns = []
+    snippet_params = {}
+    if include_search_1:
+        extra_columns.append("search_index.search_1")
     if q:
-        default_sort = "search_index_fts.rank, search_index.timestamp desc"
+        extra_columns.append(
+            "snippet([{fts}], -1, :snippet_start, :snippet_end, "
+            "'…', :snippet_tokens) as snippet"
+        )
+        snippet_params = {
+            "snippet_start": SNIPPET_START,
+            "snippet_end": SNIPPET_END,
+            "snippet_tokens": snippet_options.get("tokens") or SNIPPET_TOKENS,
+        }
+        if snippet_options.get("highlight_column") is not None:
+            extra_columns.append(
+                "highlight([{{fts}}], {}, :snippet_start, :snippet_end) "
+                "as highlight".format(int(snippet_options["highlight_column"]))
+            )
+
+    order = search_order(request.args, q, rank)
+    if size is None:
+        size = page_size(request.args, q, max_page_size)
+    if next_token is None:
+        next_token = request.args.get("next")
+    cursor = None
+    if next_token:
+        cursor = decode_cursor(next_token, len(order))
+
+    def table_order(fts):
+        return [
+            (expression.format(fts=fts), column, descending)
+            for expression, column, descending in order
+        ]
+
+    async def fetch(fts, extra_clauses, params, limit):
+        sql, filter_params = search_sql(
+            request.args, q, order, fts, rank, extra_columns, extra_clauses
+        )
+        results = await execute_search_sql(
+            database,
+            sql,
+            dict(filter_params, limit=limit, **params, **snippet_params),
+        )
+        rows = [dict(r) for r in results.rows]
+        for row in rows:
+            for key in ("snippet", "highlight"):
+                if row.get(key) is not None:
+                    row[key] = apply_markers(row[key], markers)
+        return rows
+
+    async def fetch_page(fts, limit):
+        if cursor is None:
+            return await fetch(fts, [], {}, limit)
+        order = table_order(fts)
+        clause, params = keyset_clause(order, cursor)
+        rows = await fetch(fts, [clause], params, limit)
+        expression, _, descending = order[0]
+        if descending and cursor[0] is not None and len(rows) < limit:
+            # keyset_clause skips nulls here - they sort last when descending
+            rows += await fetch(
+                fts, ["{} is null".format(expression)], {}, limit - len(rows)
+            )
+        return rows
+
+    # Fetch one extra row to find out if there is a next page
+    if not (q and partitions):
+        rows = await fetch_page(FTS_TABLE, size + 1)
+    elif order[0][1] == "timestamp":
+        # Partitions are visited in the same order as the results, so this
+        # can stop as soon as it has found enough of them
+        rows = []
+        for fts in partitions_for(partitions, request.args, order[0][2]):
+            rows += await fetch_page(fts, size + 1 - len(rows))
+            if len(rows) > size:
+                break
     else:
-        default_sort = "search_index.timestamp desc"
-    order_by = SORT_ORDERS.get(request.args.get("sort"), default_sort)
+        # The best results from each partition, merged by relevance
+        pages = await asyncio.gather(
+            *(
+                fetch_page(fts, size + 1)
+                for fts in partitions_for(partitions, request.args)
+            )
+        )
+        rows = sort_rows([row for page in pages for row in page], order)[: size + 1]
+    next_token = None
+    if len(rows) > size:
+        rows = rows[:size]
+        next_token = encode_cursor([rows[-1][column] for _, column, _ in order])
+    return rows, next_token
+
+
+def search_order(args, q, rank=DEFAULT_RANK):
+    default_order = relevance_order(rank) if q else SORT_ORDERS["newest"]
+    return SORT_ORDERS.get(args.get("sort"), default_order)
+
+
+def search_sql(
+    args, q, order, fts=FTS_TABLE, rank=DEFAULT_RANK, extra_columns=(), extra_clauses=()
+):
+    # Returns (sql, params) for a page of results from one full-text table,
+    # leaving :limit and any parameters used by extra_clauses to the caller
+    where_clauses, params = search_filters(args, q, fts)
+    where_clauses.extend(extra_clauses)
+    sql = (SEARCH_SQL if q else TIMELINE_SQL).format(
+        rank=rank.format(fts=fts),
+        extra_columns="".join(
+            ",\n  " + column.format(fts=fts) for column in extra_columns
+        ),
+        from_=SEARCH_FROM.format(fts=fts),
+        where=" where " if where_clauses else "",
+        where_clauses=" and ".join(where_clauses),
+        order_by=", ".join(
+            expression.format(fts=fts) + (" desc" if descending else "")
+            for expression, _, descending in order
+        ),
+    )
+    return sql, params
+
+
+def partitions_for(partitions, args, descending=True):
+    # The partition tables that might contain rows matching the date filters
+    # in args, in timestamp order - undated rows have a null timestamp, which
+    # sorts before any other value
+    bounds = timestamp_bounds(args)
+    tables = [
+        partitions[year]
+        for year in sorted(
+            (year for year in partitions if year != "undated"), reverse=descending
+        )
+        if all(
+            str(int(year) + 1) > value if operator == ">=" else year < value
+            for operator, value in bounds
+        )
+    ]
+    if "undated" in partitions and not bounds:
+        if descending:
+            tables.append(partitions["undated"])
+        else:
+            tables.insert(0, partitions["undated"])
+    return tables
+
+
+def sort_rows(rows, order):
+    # Sorts rows in Python the same way as the SQL order by clause
+    for _, column, descending in reversed(order):
+        rows.sort(
+            key=lambda row: (row[column] is not None, row[column]),
+            reverse=descending,
+        )
+    return rows
+
+
+def apply_markers(text, markers):
+    return (
+        html.escape(text)
+        .replace(SNIPPET_START, markers[0])
+        .replace(SNIPPET_END, markers[1])
+    )
+
 
+def page_size(args, q, max_page_size=MAX_PAGE_SIZE):
+    from datasette.utils.asgi import BadRequest
+
+    default = SEARCH_PAGE_SIZE if q else TIMELINE_PAGE_SIZE
+    if not args.get("size"):
+        return min(default, max_page_size)
+    try:
+        size = int(args["size"])
+    except ValueError:
+        size = 0
+    if not 0 < size <= max_page_size:
+        raise BadRequest("size must be between 1 and {}".format(max_page_size))
+    return size
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode(
+        "utf-8"
+    )
+
+
+def decode_cursor(token, length):
+    from datasette.utils.asgi import BadRequest
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode("utf-8")))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != length:
+        raise BadRequest("Invalid next token")
+    return values
+
+
+def keyset_clause(order, values):
+    # Returns (sql, params) matching rows that sort after values in order
+    params = {
+        "cursor_{}".format(i): value
+        for i, value in enumerate(values)
+        if value is not None
+    }
+    directions = {descending for _, _, descending in order}
+    if None not in values and len(directions) == 1:
+        # A row value comparison can be satisfied using an index range,
+        # but does not match rows with nulls in them
+        return (
+            "({}) {} ({})".format(
+                ", ".join(expression for expression, _, _ in order),
+                "<" if order[0][2] else ">",
+                ", ".join(":cursor_{}".format(i) for i in range(len(values))),
+            ),
+            params,
+        )
+    # Otherwise spell out each case, remembering that nulls sort first
+    alternatives = []
+    equal_so_far = []
+    for i, ((expression, _, descending), value) in enumerate(zip(order, values)):
+        if value is None:
+            after = None if descending else "{} is not null".format(expression)
+            equal = "{} is null".format(expression)
+        else:
+            if descending:
+                after = "({0} < :cursor_{1} or {0} is null)".format(expression, i)
+            else:
+                after = "{} > :cursor_{}".format(expression, i)
+            equal = "{} = :cursor_{}".format(expression, i)
+        if after:
+            alternatives.append("({})".format(" and ".join(equal_so_far + [after])))
+        equal_so_far.append(equal)
+    return "({})".format(" or ".join(alternatives) or "0"), params
+
+
+def search_filters(args, q, fts=FTS_TABLE):
+    # Returns (where_clauses, params) for the search term and filters in args.
+    # Pass fts=None to leave out the full-text match
     params = {"query": q}
     where_clauses = []
-    if request.args.get("timestamp__date"):
-        where_clauses.append('date("timestamp") = :date')
-        params["date"] = request.args["timestamp__date"]
-    sql = TIMELINE_SQL
-    if q:
-        sql = SEARCH_SQL
-        where_clauses.append("search_index_fts match :query")
+    # Ranges rather than date("timestamp") so the timestamp index can be used
+    for i, (operator, value) in enumerate(timestamp_bounds(args)):
+        where_clauses.append(
+            "search_index.timestamp {} :timestamp_{}".format(operator, i)
+        )
+        params["timestamp_{}".format(i)] = value
+    if q and fts:
+        where_clauses.append("[{}] match :query".format(fts))
     for arg in FILTER_COLS:
-        if arg in request.args:
+        if arg in args:
             where_clauses.append("[{arg}]=:{arg}".format(arg=arg))
-            params[arg] = request.args[arg]
-    sql_to_execute = sql.format(
-        where=" where " if where_clauses else "",
-        where_clauses=" and ".join(where_clauses),
-        order_by=order_by,
-    )
+            params[arg] = args[arg]
+    return where_clauses, params
+
+
+def summary_filters(args):
+    # Returns (where_clauses, params) for filtering search_index_summary, or
+    # None if the date filters are more precise than the day it records
+    where_clauses, params = [], {}
+    for i, (operator, value) in enumerate(timestamp_bounds(args)):
+        if len(value) != len("YYYY-MM-DD"):
+            return None
+        where_clauses.append("day {} :timestamp_{}".format(operator, i))
+        params["timestamp_{}".format(i)] = value
+    for arg in FILTER_COLS:
+        if arg in args:
+            where_clauses.append("[{arg}]=:{arg}".format(arg=arg))
+            params[arg] = args[arg]
+    return where_clauses, params
+
+
+def timestamp_bounds(args):
+    # Returns (operator, value) pairs for the date arguments, as half-open
+    # ranges that work for ISO timestamps compared as strings
+    from datasette.utils.asgi import BadRequest
+
+    bounds = []
     try:
-        results = await database.execute(sql_to_execute, params)
-    except sqlite3.OperationalError as e:
-        params["query"] = escape_fts(params["query"])
-        results = await database.execute(sql_to_execute, params)
-    return [dict(r) for r in results.rows]
+        if args.get("timestamp__date"):
+            day = datetime.date.fromisoformat(args["timestamp__date"])
+            bounds.append((">=", day.isoformat()))
+            bounds.append(("<", (day + datetime.timedelta(days=1)).isoformat()))
+        if args.get("timestamp__month"):
+            year, month = map(int, args["timestamp__month"].split("-"))
+            start = datetime.date(year, month, 1)
+            end = datetime.date(year + month // 12, month % 12 + 1, 1)
+            bounds.append((">=", start.isoformat()))
+            bounds.append(("<", end.isoformat()))
+        if args.get("timestamp__year"):
+            year = int(args["timestamp__year"])
+            bounds.append((">=", datetime.date(year, 1, 1).isoformat()))
+            bounds.append(("<", datetime.date(year + 1, 1, 1).isoformat()))
+    except ValueError as e:
+        raise BadRequest("Invalid date: {}".format(e))
+    if args.get("timestamp__gte"):
+        bounds.append((">=", args["timestamp__gte"]))
+    if args.get("timestamp__lt"):
+        bounds.append(("<", args["timestamp__lt"]))
+    return bounds
+
 
+async def execute_search_sql(database, sql, params):
+    # Tries the search term as raw FTS syntax first, then escaped
+    from datasette.utils import sqlite3, escape_fts
+
+    try:
+        return await database.execute(sql, params)
+    except sqlite3.OperationalError:
+        params = dict(params, query=escape_fts(params["query"]))
+        with timed("fts_retry"):
+            return await database.execute(sql, params)
 
-async def process_results(datasette, results, rules, q, template_debug=False):
-    # Adds a 'display' property with HTML to the results
-    templates_by_type = {}
-    rules_by_type = {}
-    for db_name, types in rules.items():
-        for type_, meta in types.items():
-            rules_by_type["{}/{}".format(db_name, type_)] = meta
 
+async def process_results(
+    datasette,
+    results,
+    beta_config,
+    q,
+    template_debug=False,
+    display_concurrency=DISPLAY_CONCURRENCY,
+    fragment_cache=None,
+    generation=None,
+):
+    # Adds a 'display' property with HTML to the results. Output for items
+    # that does not depend on q is stored in fragment_cache, if provided
     for result in results:
+        # These have already been HTML escaped by apply_markers()
+        for key in ("snippet", "highlight"):
+            if result.get(key) is not None:
+                result[key] = Markup(result[key])
+    to_render = []
+    for result in results:
+        fragment_key = None
+        fragment_hash = beta_config.fragment_hashes[result["type"]]
+        if fragment_cache is not None and fragment_hash is not None:
+            fragment_key = ["fragment", result["type"], result["key"], fragment_hash]
+            cached = fragment_cache.get(generation, fragment_key)
+            if cached is not None:
+                result["display"], result["output"] = cached
+                continue
+        to_render.append((result, fragment_key))
+    await fetch_display(
+        datasette,
+        [result for result, _ in to_render],
+        beta_config,
+        q,
+        display_concurrency,
+    )
+    for result, fragment_key in to_render:
         type_ = result["type"]
-        meta = rules_by_type[type_]
-        result["display"] = {}
-        if meta.get("display_sql"):
-            db = datasette.get_database(type_.split(".")[0])
-            display_results = await db.execute(
-                meta["display_sql"], {"key": result["key"], "q": q}
-            )
-            first = display_results.first()
-            if first:
-                result["display"] = dict(first)
+        meta = beta_config.rules_by_type[type_]
         output = None
         if meta.get("display"):
-            if type_ not in templates_by_type:
-                compiled = Template(meta["display"], autoescape=True)
-                templates_by_type[type_] = compiled
-            else:
-                compiled = templates_by_type[type_]
+            compiled = beta_config.template(type_)
             try:
-                output = compiled.render({**result, **{"json": json}})
+                with timed("render", type_):
+                    output = compiled.render({**result, **{"json": json}})
             except Exception as e:
                 if not template_debug:
                     raise
+                fragment_key = None
                 output = '<p style="color: red">{}</p><pre>{}</pre><p>Template:</p><pre>{}</pre>'.format(
                     html.escape(str(e)),
                     html.escape(json.dumps(result, default=repr, indent=4)),
@@ -188,14 +1050,172 @@ async def process_results(datasette, results, rules, q, template_debug=False):
                 html.escape(json.dumps(result, default=repr, indent=4))
             )
         result["output"] = output
+        if fragment_key is not None:
+            fragment_cache.set(
+                generation, fragment_key, [result["display"], result["output"]]
+            )
 
 
-async def get_count_and_facets(datasette, database_name, request):
-    from datasette.utils.asgi import Request, Response
-    from datasette.utils import sqlite3, escape_fts
+async def fetch_display(
+    datasette, results, beta_config, q, concurrency=DISPLAY_CONCURRENCY
+):
+    # Populates result["display"] using display_sql_batch or display_sql,
+    # running up to `concurrency` of those queries at once
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_batch(db, sql, type_results):
+        # One query per type, rows are matched back up using their key
+        async with semaphore:
+            with timed("display_sql", type_results[0]["type"]):
+                display_results = await db.execute(
+                    sql,
+                    {
+                        "keys": json.dumps(
+                            [result["key"] for result in type_results]
+                        ),
+                        "q": q,
+                    },
+                )
+        by_key = {}
+        for row in display_results.rows:
+            by_key.setdefault(str(row["key"]), dict(row))
+        for result in type_results:
+            result["display"] = by_key.get(str(result["key"]), {})
+
+    async def fetch_one(db, sql, result):
+        async with semaphore:
+            with timed("display_sql", result["type"]):
+                display_results = await db.execute(
+                    sql, {"key": result["key"], "q": q}
+                )
+        first = display_results.first()
+        if first:
+            result["display"] = dict(first)
+
+    results_by_type = {}
+    for result in results:
+        result["display"] = {}
+        results_by_type.setdefault(result["type"], []).append(result)
+    fetches = []
+    for type_, type_results in results_by_type.items():
+        meta = beta_config.rules_by_type[type_]
+        db = datasette.get_database(type_.split(".")[0])
+        if meta.get("display_sql_batch"):
+            fetches.append(fetch_batch(db, meta["display_sql_batch"], type_results))
+        elif meta.get("display_sql"):
+            fetches.extend(
+                fetch_one(db, meta["display_sql"], result) for result in type_results
+            )
+    await asyncio.gather(*fetches)
 
+
+async def get_count_and_facets(
+    datasette,
+    database_name,
+    request,
+    facet_engine="sql",
+    partitions=None,
+    use_summary=False,
+):
+    # Datasette does not know how to search a partitioned index
+    if facet_engine == "datasette" and not partitions:
+        return await get_count_and_facets_datasette(datasette, database_name, request)
+    return await get_count_and_facets_sql(
+        datasette, database_name, request, partitions, use_summary
+    )
+
+
+async def get_count_and_facets_sql(
+    datasette, database_name, request, partitions=None, use_summary=False
+):
+    # Calculates count and all facets using a single SQL query
+    database = datasette.get_database(database_name)
+    q = (request.args.get("q") or "").strip()
+    sql, params = facet_sql(request.args, q, partitions, use_summary)
+    params["facet_size"] = datasette.setting("default_facet_size")
+    rows = (await execute_search_sql(database, sql, params)).rows
+    count = 0
+    facets = {name: {"name": name, "results": []} for name in FACET_NAMES}
+    for row in rows:
+        if row["facet"] == "count":
+            count = row["count"]
+            continue
+        arg = FACET_NAMES[row["facet"]]
+        selected = str(row["value"]) == request.args.get(arg)
+        facets[row["facet"]]["results"].append(
+            {
+                "value": row["value"],
+                "label": row["label"],
+                "count": row["count"],
+                "toggle_url": facet_toggle_url(
+                    request.args, q, arg, row["value"], selected
+                ),
+                "selected": selected,
+            }
+        )
+    return count, facets.values()
+
+
+def facet_sql(args, q, partitions=None, use_summary=False):
+    # Returns (sql, params) for the count and facets, leaving :facet_size to
+    # the caller
+    summary = summary_filters(args) if use_summary and not q else None
+    if summary is not None:
+        where_clauses, params = summary
+        matches, from_, count = SUMMARY_MATCHES_SQL, None, "sum(n)"
+    elif q and partitions:
+        where_clauses, params = search_filters(args, q, fts=None)
+        matches, count = FACET_MATCHES_SQL, "count(*)"
+        from_ = (
+            "search_index join ({}) as partition_matches "
+            "on search_index.rowid = partition_matches.rowid"
+        ).format(
+            " union all ".join(
+                "select rowid from [{0}] where [{0}] match :query".format(fts)
+                for fts in partitions_for(partitions, args)
+            )
+            or "select null as rowid where 0"
+        )
+    else:
+        where_clauses, params = search_filters(args, q)
+        matches, count = FACET_MATCHES_SQL, "count(*)"
+        from_ = SEARCH_FROM.format(fts=FTS_TABLE) if q else "search_index"
+    sql = FACET_SQL.format(
+        matches=matches.format(
+            from_=from_,
+            where=" where " if where_clauses else "",
+            where_clauses=" and ".join(where_clauses),
+        ),
+        count=count,
+        total="coalesce({}, 0)".format(count),
+    )
+    return sql, params
+
+
+def facet_toggle_url(args, q, arg, value, selected):
+    qs_bits = {key: args[key] for key in FACET_ARGS if key in args}
+    if selected:
+        qs_bits.pop(arg, None)
+    else:
+        qs_bits[arg] = value
+    qs_bits["q"] = q
+    return "?" + urllib.parse.urlencode(qs_bits)
+
+
+async def get_count_and_facets_datasette(datasette, database_name, request):
+    # Uses an internal request to Datasette's table view for search_index
     q = (request.args.get("q") or "").strip()
     timestamp__date = request.args.get("timestamp__date") or ""
+    # Datasette has no month or year filters, so send those as ranges
+    timestamp_ranges = {"timestamp__gte": [], "timestamp__lt": []}
+    range_args = {
+        key: request.args[key]
+        for key in DATE_ARGS
+        if key in request.args and key != "timestamp__date"
+    }
+    for operator, value in timestamp_bounds(range_args):
+        key = "timestamp__gte" if operator == ">=" else "timestamp__lt"
+        timestamp_ranges[key].append(value)
 
     async def execute_search(searchmode_raw):
         args = {
@@ -210,6 +1230,9 @@ async def get_count_and_facets(datasette, database_name, request):
                 args["_searchmode"] = "raw"
         if timestamp__date:
             args["timestamp__date"] = timestamp__date
+        for key, values in timestamp_ranges.items():
+            if values:
+                args[key] = values
         for column in FILTER_COLS:
             if column in request.args:
                 args[column] = request.args[column]
@@ -260,7 +1283,23 @@ async def get_count_and_facets(datasette, database_name, request):
 
 @hookimpl
 def register_routes():
-    return [("/-/beta", beta)]
+    return [
+        (r"^/-/beta\.json$", beta_json),
+        (r"^/-/beta\.ndjson$", beta_ndjson),
+        (r"^/-/beta/stats$", beta_stats),
+        (r"^/-/beta/suggest$", beta_suggest),
+        (r"^/-/beta$", beta),
+    ]
+
+
+@hookimpl
+def startup(datasette):
+    # Note the inode of each database file, so reopen_if_replaced() can tell
+    # if the index is swapped before the first search
+    for database in datasette.databases.values():
+        if database.path and os.path.exists(database.path):
+            inode = os.stat(database.path).st_ino
+            _index_inodes.setdefault(database.path, inode)
 
 
 @hookimpl
@@ -0,0 +1,231 @@
+import asyncio
+import datetime
+import importlib.metadata
+import json
+import os
+import platform
+import random
+import sqlite3
+import sqlite_utils
+import time
+from .timing import summarize
+from .utils import run_indexer
+
+# A Zipf-like vocabulary, so a few words are very common and most are rare
+VOCABULARY_SIZE = 5000
+INSERT_BATCH_SIZE = 10000
+SEARCH_TERMS = 20
+SCENARIOS = ("timeline", "search", "faceted", "display")
+QUERY_TIME_LIMIT_MS = 60 * 1000
+
+
+def generate_corpus(directory, databases=2, rows=10000, seed=0):
+    """
+    Write databases source_N.db to directory, each with an items table of rows
+    synthetic records. Returns the dogsheep-beta config rules for indexing them.
+    """
+    rng = random.Random(seed)
+    words = make_vocabulary(rng)
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    cumulative = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    now = datetime.datetime(2021, 1, 1)
+    rules = {}
+    for i in range(databases):
+        db_name = "source_{}.db".format(i)
+        path = os.path.join(directory, db_name)
+        if os.path.exists(path):
+            os.remove(path)
+        db = sqlite_utils.Database(path)
+        db["items"].create(
+            {
+                "id": int,
+                "title": str,
+                "body": str,
+                "created": str,
+                "kind": int,
+                "public": int,
+            },
+            pk="id",
+        )
+
+        def text(length):
+            return " ".join(rng.choices(words, cum_weights=cumulative, k=length))
+
+        def generate():
+            for id in range(1, rows + 1):
+                # Most items are recent, with a long tail going back years
+                age = rng.expovariate(1 / 365)
+                yield (
+                    id,
+                    text(rng.randint(3, 10)),
+                    # Body lengths follow a log-normal distribution, like
+                    # a mix of short messages and longer documents
+                    text(min(int(rng.lognormvariate(3.5, 1)) + 1, 2000)),
+                    (now - datetime.timedelta(days=age)).isoformat(
+                        timespec="seconds"
+                    ),
+                    rng.choice((1, 2, 3)),
+                    int(rng.random() < 0.3),
+                )
+
+        batch = []
+        with db.conn:
+            for row in generate():
+                batch.append(row)
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    db.conn.executemany(
+                        "insert into items values (?, ?, ?, ?, ?, ?)", batch
+                    )
+                    batch = []
+            db.conn.executemany("insert into items values (?, ?, ?, ?, ?, ?)", batch)
+        db.conn.close()
+        rules[db_name] = {
+            "items": {
+                "sql": (
+                    "select id as key, title, created as timestamp, "
+                    "kind as category, public as is_public, body as search_1 "
+                    "from items"
+                ),
+                "display_sql": (
+                    "select id, title, body, created from items where id = :key"
+                ),
+                "display": (
+                    "<h3>{{ display.title }}</h3><p>{{ display.created }}</p>"
+                    "<p>{{ display.body[:200] }}</p>"
+                ),
+            }
+        }
+    return rules
+
+
+def make_vocabulary(rng):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add("".join(rng.choices(letters, k=rng.randint(3, 10))))
+    return sorted(words)
+
+
+def run_benchmark(directory, databases=2, rows=10000, iterations=50, seed=0):
+    "Generate a corpus in directory, index it and time queries against it"
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    previous_cwd = os.getcwd()
+    # The config refers to the source databases using relative paths
+    os.chdir(directory)
+    try:
+        rules = generate_corpus(directory, databases, rows, seed)
+        with open("dogsheep-beta.json", "w") as fp:
+            json.dump(rules, fp, indent=4)
+        results = {
+            "version": importlib.metadata.version("dogsheep-beta"),
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(
+                timespec="seconds"
+            ),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "settings": {
+                "databases": databases,
+                "rows": rows,
+                "iterations": iterations,
+                "seed": seed,
+            },
+            "indexing": benchmark_indexing(rules, databases * rows),
+        }
+        results["queries"] = asyncio.run(
+            benchmark_queries(rules, iterations, random.Random(seed))
+        )
+        return results
+    finally:
+        os.chdir(previous_cwd)
+
+
+def benchmark_indexing(rules, total_rows):
+    if os.path.exists("beta.db"):
+        os.remove("beta.db")
+    start = time.perf_counter()
+    run_indexer("beta.db", rules)
+    index_seconds = time.perf_counter() - start
+    db = sqlite_utils.Database("beta.db")
+    start = time.perf_counter()
+    with db.conn:
+        db.conn.execute(
+            'INSERT INTO search_index_fts(search_index_fts) VALUES ("rebuild")'
+        )
+    rebuild_seconds = time.perf_counter() - start
+    db.conn.close()
+    return {
+        "rows": total_rows,
+        "seconds": index_seconds,
+        "rows_per_second": total_rows / index_seconds,
+        "fts_rebuild_seconds": rebuild_seconds,
+        "index_bytes": os.path.getsize("beta.db"),
+    }
+
+
+async def benchmark_queries(rules, iterations, rng):
+    from datasette.app import Datasette
+
+    ds = Datasette(
+        ["beta.db"] + list(rules),
+        metadata={
+            "plugins": {
+                "dogsheep-beta": {
+                    "database": "beta",
+                    "config_file": "dogsheep-beta.json",
+                    # Otherwise repeated queries would just be cache hits
+                    "cache_max_bytes": 0,
+                }
+            }
+        },
+        # Measure slow queries rather than having them time out
+        settings={"sql_time_limit_ms": QUERY_TIME_LIMIT_MS},
+    )
+    terms = search_terms(SEARCH_TERMS)
+    types = ["{}/items".format(db_name) for db_name in rules]
+    paths = {
+        "timeline": lambda: "/-/beta.json",
+        "search": lambda: "/-/beta.json?q={}".format(rng.choice(terms)),
+        "faceted": lambda: "/-/beta.json?q={}&type={}&is_public=1".format(
+            rng.choice(terms), rng.choice(types)
+        ),
+        "display": lambda: "/-/beta.json?q={}&size=100&_output=1".format(
+            rng.choice(terms)
+        ),
+    }
+    results = {}
+    for scenario in SCENARIOS:
+        timings = []
+        errors = 0
+        for _ in range(iterations):
+            path = paths[scenario]()
+            start = time.perf_counter()
+            response = await ds.client.get(path)
+            timings.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+        results[scenario] = dict(summarize(timings), errors=errors)
+    return results
+
+
+def search_terms(count):
+    # Indexed words spread from the most to the least common, so searches
+    # range from matching most documents to matching just a few
+    db = sqlite_utils.Database("beta.db")
+    db.execute(
+        "create virtual table temp.search_index_terms "
+        "using fts5vocab(main, 'search_index_fts', 'row')"
+    )
+    terms = [
+        row[0]
+        for row in db.execute(
+            "select term from temp.search_index_terms order by doc desc"
+        )
+    ]
+    db.conn.close()
+    step = max(1, len(terms) // count)
+    return terms[::step][:count]
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+import json
+import sqlite3
+
+_caches = {}
+
+
+class LRUCache:
+    "In-memory cache of JSON strings, evicting least recently used beyond max_bytes"
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        if key in self._items:
+            self.size -= len(self._items.pop(key))
+        self._items[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SQLiteCache:
+    """
+    Cache stored in a SQLite file, so it can be shared between processes.
+    This is used from the event loop, so it never waits for a lock held by
+    another process - a locked file counts as a miss, and values that cannot
+    be stored straight away are skipped.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=0, check_same_thread=False)
+        self.ready = False
+        self.generation = None
+
+    def setup(self):
+        if self.ready:
+            return
+        self.conn.execute("PRAGMA journal_mode=wal")
+        with self.conn:
+            self.conn.execute(
+                "create table if not exists cache "
+                "(key text primary key, generation, value text)"
+            )
+        self.ready = True
+
+    def get(self, key):
+        try:
+            self.setup()
+            row = self.conn.execute(
+                "select value from cache where key = ?", [key]
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row else None
+
+    def set(self, key, value, generation):
+        try:
+            self.setup()
+            with self.conn:
+                if generation != self.generation:
+                    # Entries from older generations can never be hit again
+                    self.conn.execute(
+                        "delete from cache where generation is not ?", [generation]
+                    )
+                    self.generation = generation
+                self.conn.execute(
+                    "replace into cache (key, generation, value) values (?, ?, ?)",
+                    [key, generation, value],
+                )
+        except sqlite3.OperationalError:
+            # Probably locked by another process - skip storing this one
+            pass
+
+
+class GenerationCache:
+    """
+    Two tier cache of JSON-serializable values, keyed on the index generation
+    so that re-running the indexer invalidates everything stored previously
+    """
+
+    def __init__(self, max_bytes, path=None):
+        self.memory = LRUCache(max_bytes)
+        self.disk = SQLiteCache(path) if path else None
+
+    def get(self, generation, key):
+        cache_key = json.dumps([generation, key])
+        value = self.memory.get(cache_key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(cache_key)
+            if value is not None:
+                self.memory.set(cache_key, value)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, generation, key, value):
+        cache_key = json.dumps([generation, key])
+        value = json.dumps(value, default=repr)
+        self.memory.set(cache_key, value)
+        if self.disk is not None:
+            self.disk.set(cache_key, value, generation)
+
+
+def get_cache(name, max_bytes, path=None):
+    "Returns the process-wide GenerationCache for these settings"
+    key = (name, max_bytes, path)
+    if key not in _caches:
+        _caches[key] = GenerationCache(max_bytes, path)
+    return _caches[key]
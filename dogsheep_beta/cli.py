@@ -1,5 +1,14 @@
 import click
-from .utils import parse_metadata, run_indexer
+import json
+from .utils import (
+    FTS_COLUMNS,
+    MAINTENANCE_MODES,
+    VerificationError,
+    parse_metadata,
+    run_indexer,
+    run_pruner,
+)
+from .watch import BATCH_SIZE, DEBOUNCE, POLL_INTERVAL, run_watcher
 
 
 @click.group()
@@ -30,12 +39,408 @@ def cli():
     multiple=True,
     help="Databases to index - defaults to all",
 )
-def index(db_path, config, tokenize, database):
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only index rows newer than last time, for types with a since: column",
+)
+@click.option(
+    "--prune",
+    is_flag=True,
+    help="Also remove rows that no longer exist in the source databases",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of processes to use for reading from the source databases",
+)
+@click.option(
+    "fts_columns",
+    "--fts-column",
+    type=click.Choice(FTS_COLUMNS),
+    multiple=True,
+    help="Columns to include in the full-text index - defaults to those of the "
+    "existing index, or all of them",
+)
+@click.option(
+    "--progress",
+    is_flag=True,
+    help="Show progress for each type, then a summary of where the time went",
+)
+@click.option(
+    "--stats-json",
+    type=click.File("w"),
+    help="Write rows and timings for each type and phase to this file as JSON",
+)
+@click.option(
+    "--maintenance",
+    type=click.Choice(MAINTENANCE_MODES),
+    default="auto",
+    help="How to tidy up the index afterwards - defaults to auto",
+)
+@click.option(
+    "--partition-by-year/--no-partition-by-year",
+    default=None,
+    help="Use a separate full-text index for each year - defaults to how the "
+    "existing index was built",
+)
+@click.option(
+    "--autocomplete/--no-autocomplete",
+    default=None,
+    help="Add prefix indexes and a table of terms, for /-/beta/suggest - "
+    "defaults to how the existing index was built",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    help="Commit each type in batches of this many rows, recording a "
+    "checkpoint after each batch that --resume can continue from",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue an interrupted run, skipping the types it finished",
+)
+@click.option(
+    "--swap",
+    is_flag=True,
+    help="Build a new index alongside DB_PATH, then swap it into place",
+)
+def index(
+    db_path,
+    config,
+    tokenize,
+    database,
+    incremental=False,
+    prune=False,
+    workers=1,
+    fts_columns=None,
+    progress=False,
+    stats_json=None,
+    maintenance="auto",
+    partition_by_year=None,
+    autocomplete=None,
+    batch_size=None,
+    resume=False,
+    swap=False,
+):
     "Create a search index based on rules in the config file"
+    if resume and (incremental or workers > 1):
+        raise click.UsageError(
+            "--resume cannot be used with --incremental or --workers"
+        )
+    if batch_size and workers > 1:
+        # Each worker's rows are merged into the index in one transaction
+        raise click.UsageError("--batch-size cannot be used with --workers")
+    if swap and (incremental or database):
+        # The new index would only contain some of the rows
+        raise click.UsageError("--swap cannot be used with --incremental or -d")
     rules = parse_metadata(open(config).read())
-    run_indexer(
-        db_path,
-        rules,
-        tokenize=None if tokenize == "none" else tokenize,
-        databases=database,
+    try:
+        stats = run_indexer(
+            db_path,
+            rules,
+            tokenize=None if tokenize == "none" else tokenize,
+            databases=database,
+            incremental=incremental,
+            prune=prune,
+            workers=workers,
+            fts_columns=fts_columns,
+            progress=show_progress if progress else None,
+            maintenance=maintenance,
+            partition="year" if partition_by_year else partition_by_year,
+            autocomplete=autocomplete,
+            batch_size=batch_size,
+            resume=resume,
+            swap=swap,
+        )
+    except VerificationError as e:
+        raise click.ClickException("New index failed verification: {}".format(e))
+    if progress:
+        show_summary(stats)
+    if stats_json:
+        json.dump(stats, stats_json, indent=4)
+
+
+def show_progress(event):
+    message = "{}: ".format(event["type"])
+    if event["rows"] is not None:
+        message += "{:,} rows in {}".format(
+            event["rows"], format_seconds(event["seconds"])
+        )
+        if event["seconds"]:
+            message += ", {:,.0f} rows/sec".format(event["rows"] / event["seconds"])
+    elif event["seconds"] < 1:
+        message += "indexing"
+        if event["total"] is not None:
+            message += " {:,} rows".format(event["total"])
+    else:
+        message += "{} elapsed".format(format_seconds(event["seconds"]))
+    if event["eta"] is not None:
+        message += ", ETA {}".format(format_seconds(event["eta"]))
+    click.echo(message, err=True)
+
+
+def show_summary(stats):
+    click.echo(
+        "Indexed {:,} rows in {}".format(
+            stats["rows"], format_seconds(stats["seconds"])
+        ),
+        err=True,
+    )
+    if stats["maintenance"]:
+        click.echo("Maintenance: {}".format(stats["maintenance"]), err=True)
+    for name, seconds in sorted(stats["phases"].items(), key=lambda p: -p[1]):
+        click.echo("  {:<20}{:>10}".format(name, format_seconds(seconds)), err=True)
+
+
+def format_seconds(seconds):
+    if seconds < 60:
+        return "{:.2f}s".format(seconds)
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument(
+    "config",
+    type=click.Path(file_okay=True, dir_okay=False, exists=True),
+    required=True,
+)
+@click.option(
+    "--tokenize",
+    help="Tokenizer to use. Defaults to porter, set to none to disable.",
+    default="porter",
+)
+@click.option(
+    "-d",
+    "--database",
+    multiple=True,
+    help="Databases to watch - defaults to all",
+)
+@click.option(
+    "fts_columns",
+    "--fts-column",
+    type=click.Choice(FTS_COLUMNS),
+    multiple=True,
+    help="Columns to include in the full-text index - defaults to those of the "
+    "existing index, or all of them",
+)
+@click.option(
+    "--partition-by-year/--no-partition-by-year",
+    default=None,
+    help="Use a separate full-text index for each year - defaults to how the "
+    "existing index was built",
+)
+@click.option(
+    "--autocomplete/--no-autocomplete",
+    default=None,
+    help="Add prefix indexes and a table of terms, for /-/beta/suggest - "
+    "defaults to how the existing index was built",
+)
+@click.option(
+    "--interval",
+    type=click.FloatRange(min=0),
+    default=POLL_INTERVAL,
+    help="Seconds between checks for changes - defaults to 1",
+)
+@click.option(
+    "--debounce",
+    type=click.FloatRange(min=0),
+    default=DEBOUNCE,
+    help="Seconds a database must go unchanged before it is re-indexed - "
+    "defaults to 2",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=BATCH_SIZE,
+    help="Commit types with a since: column in batches of this many rows - "
+    "defaults to 1,000",
+)
+@click.option(
+    "--maintenance",
+    type=click.Choice(MAINTENANCE_MODES),
+    default="light",
+    help="How to tidy up the index after each change - defaults to light",
+)
+def watch(
+    db_path,
+    config,
+    tokenize,
+    database,
+    fts_columns,
+    partition_by_year,
+    autocomplete,
+    interval,
+    debounce,
+    batch_size,
+    maintenance,
+):
+    "Keep the search index up to date as the source databases change"
+    click.echo("Watching for changes, press Ctrl+C to stop", err=True)
+    try:
+        run_watcher(
+            db_path,
+            config,
+            databases=database,
+            interval=interval,
+            debounce=debounce,
+            batch_size=batch_size,
+            on_index=show_index_event,
+            tokenize=None if tokenize == "none" else tokenize,
+            fts_columns=fts_columns,
+            partition="year" if partition_by_year else partition_by_year,
+            autocomplete=autocomplete,
+            maintenance=maintenance,
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+def show_index_event(event):
+    databases = ", ".join(event["databases"])
+    if event["error"]:
+        click.echo("{}: {} - will retry".format(databases, event["error"]), err=True)
+    else:
+        click.echo(
+            "{}: indexed {:,} rows in {}".format(
+                databases,
+                event["stats"]["rows"],
+                format_seconds(event["stats"]["seconds"]),
+            ),
+            err=True,
+        )
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+    required=True,
+)
+@click.argument(
+    "config",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True),
+    required=True,
+)
+@click.option(
+    "-d",
+    "--database",
+    multiple=True,
+    help="Databases to prune - defaults to all",
+)
+def prune(db_path, config, database):
+    "Remove rows from the index that are no longer returned by the config SQL"
+    rules = parse_metadata(open(config).read())
+    deleted = run_pruner(db_path, rules, databases=database)
+    click.echo("Deleted {} row{}".format(deleted, "" if deleted == 1 else "s"))
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+    required=True,
+)
+@click.option(
+    "queries",
+    "-q",
+    "--query",
+    multiple=True,
+    help="Querystring to explain, e.g. 'type=twitter.db/tweets&is_public=1' - "
+    "defaults to a set of sample filter combinations",
+)
+@click.option("--facets", is_flag=True, help="Also explain the count and facets SQL")
+@click.option("--sql", is_flag=True, help="Show the SQL for each query")
+def explain(db_path, queries, facets, sql):
+    "Show query plans for the SQL used by the search page"
+    from .explain import explain_queries
+
+    explained = explain_queries(db_path, queries or None, facets)
+    for query in explained:
+        click.echo(query["label"])
+        if sql:
+            click.echo(query["sql"])
+        for detail in query["plan"]:
+            flagged = detail.strip() in query["warnings"]
+            click.echo("    {}{}".format(detail, "  <-- !" if flagged else ""))
+        click.echo()
+    flagged = [query for query in explained if query["warnings"]]
+    sorting = [query for query in explained if query["unflagged_sorts"]]
+    click.echo(
+        "{} of {} queries flagged for a table scan or temporary B-tree sort".format(
+            len(flagged), len(explained)
+        )
+    )
+    if sorting:
+        click.echo(
+            "{} searches or facets also use a temporary B-tree sort, which is "
+            "expected and not flagged".format(len(sorting))
+        )
+
+
+@cli.command()
+@click.argument(
+    "directory",
+    type=click.Path(file_okay=False, dir_okay=True),
+    required=True,
+)
+@click.option(
+    "--databases",
+    type=click.IntRange(min=1),
+    default=2,
+    help="Number of source databases to generate",
+)
+@click.option(
+    "--rows",
+    type=click.IntRange(min=1),
+    default=10000,
+    help="Number of rows to generate in each source database",
+)
+@click.option(
+    "--iterations",
+    type=click.IntRange(min=1),
+    default=50,
+    help="Number of times to run each type of query",
+)
+@click.option("--seed", type=int, default=0, help="Random seed for the corpus")
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("w"),
+    help="Save the results as JSON to this file",
+)
+def benchmark(directory, databases, rows, iterations, seed, output):
+    "Index a generated corpus in DIRECTORY and time queries against it"
+    from .benchmark import run_benchmark
+
+    results = run_benchmark(directory, databases, rows, iterations, seed)
+    indexing = results["indexing"]
+    click.echo(
+        "Indexed {:,} rows in {:.2f}s ({:,.0f} rows/sec), FTS rebuild {:.2f}s".format(
+            indexing["rows"],
+            indexing["seconds"],
+            indexing["rows_per_second"],
+            indexing["fts_rebuild_seconds"],
+        )
     )
+    for scenario, timings in results["queries"].items():
+        click.echo(
+            "{:<10} p50 {:8.2f}ms  p95 {:8.2f}ms  p99 {:8.2f}ms{}".format(
+                scenario,
+                timings["p50_ms"],
+                timings["p95_ms"],
+                timings["p99_ms"],
+                "  ({} errors)".format(timings["errors"]) if timings["errors"] else "",
+            )
+        )
+    if output:
+        json.dump(results, output, indent=4)
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from jinja2 import Environment, Template, TemplateSyntaxError, meta
+from .utils import parse_metadata
+
+_configs = {}
+_lock = threading.Lock()
+# Result values that depend on the search term, not just the item
+QUERY_VARIABLES = {"*", "rank", "snippet", "highlight"}
+
+
+class BetaConfig:
+    "Parsed config file plus lookups derived from it, shared between requests"
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.rules_by_type = {}
+        for db_name, types in rules.items():
+            for type_, info in types.items():
+                self.rules_by_type["{}/{}".format(db_name, type_)] = info
+        self._templates = {}
+        # Types without a display template show every column
+        self.uses_search_1 = any(
+            "search_1" in template_variables(info.get("display"))
+            for info in self.rules_by_type.values()
+        )
+        self.fragment_hashes = {
+            type_: fragment_hash(info) for type_, info in self.rules_by_type.items()
+        }
+
+    def template(self, type_):
+        # Compiled lazily so a broken template only affects results of that type
+        try:
+            return self._templates[type_]
+        except KeyError:
+            compiled = Template(self.rules_by_type[type_]["display"], autoescape=True)
+            self._templates[type_] = compiled
+            return compiled
+
+
+def template_variables(source):
+    "Variables a template may read from its context - '*' for everything"
+    if not source:
+        return {"*", "search_1"}
+    try:
+        return meta.find_undeclared_variables(Environment().parse(source))
+    except TemplateSyntaxError:
+        return {"*", "search_1"}
+
+
+def fragment_hash(info):
+    """
+    Hash of the display settings for a type, or None if the rendered output
+    for an item of that type depends on the search term
+    """
+    if QUERY_VARIABLES.intersection(template_variables(info.get("display"))):
+        return None
+    display_sql = [info.get("display_sql"), info.get("display_sql_batch")]
+    if any(re.search(r":q\b", sql) for sql in display_sql if sql):
+        return None
+    return hashlib.sha256(
+        json.dumps([info["display"]] + display_sql).encode("utf-8")
+    ).hexdigest()
+
+
+def load_config(path):
+    "Return BetaConfig for path, re-parsing only if the file has changed"
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _configs.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with _lock:
+        cached = _configs.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        with open(path) as fp:
+            config = BetaConfig(parse_metadata(fp.read()))
+        _configs[path] = (signature, config)
+        return config
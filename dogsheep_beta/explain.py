@@ -0,0 +1,108 @@
+import sqlite_utils
+import urllib.parse
+from . import (
+    FTS_TABLE,
+    facet_sql,
+    keyset_clause,
+    partitions_for,
+    search_order,
+    search_sql,
+)
+from .utils import partition_tables
+
+# Filter combinations generated by the search page - the values do not
+# affect the query plan
+SAMPLE_QUERIES = [
+    "",
+    "sort=oldest",
+    "type=example.db/items",
+    "category=1",
+    "is_public=1",
+    "type=example.db/items&is_public=1",
+    "type=example.db/items&category=1",
+    "timestamp__year=2020",
+    "type=example.db/items&timestamp__month=2020-08",
+    "q=example",
+    "q=example&type=example.db/items",
+    "q=example&sort=newest",
+]
+
+
+def explain_queries(db_path, queries=None, facets=False):
+    """
+    Run EXPLAIN QUERY PLAN against db_path for the SQL the plugin would
+    generate for each querystring. Returns a list of dictionaries with the
+    label, sql, plan, any warnings about scans or temporary B-tree sorts, and
+    the sorts that were not flagged because searches and facets need them.
+    """
+    db = sqlite_utils.Database(db_path)
+    use_summary = db["search_index_summary"].exists()
+    partitions = partition_tables(db)
+    explained = []
+    for querystring in SAMPLE_QUERIES if queries is None else queries:
+        label = "?" + querystring
+        args = dict(urllib.parse.parse_qsl(querystring))
+        q = (args.get("q") or "").strip()
+        order = search_order(args, q)
+        fts = FTS_TABLE
+        if q and partitions:
+            fts = (partitions_for(partitions, args, order[0][2]) or [fts])[0]
+        sql, params = search_sql(args, q, order, fts)
+        # Matches for a search term always have to be sorted
+        sorts = not q
+        explained.append(explain(db, label, sql, dict(params, limit=1), sorts))
+        # Later pages add a keyset clause to the same query
+        clause, cursor_params = keyset_clause(
+            [
+                (expression.format(fts=fts), column, descending)
+                for expression, column, descending in order
+            ],
+            [1] * len(order),
+        )
+        sql, params = search_sql(args, q, order, fts, extra_clauses=[clause])
+        explained.append(
+            explain(
+                db,
+                "{} (next page)".format(label),
+                sql,
+                dict(params, limit=1, **cursor_params),
+                sorts,
+            )
+        )
+        if facets:
+            sql, params = facet_sql(args, q, partitions, use_summary)
+            explained.append(
+                explain(
+                    db,
+                    "{} (facets)".format(label),
+                    sql,
+                    dict(params, facet_size=1),
+                    # So does grouping the matches for each facet
+                    sorts=False,
+                )
+            )
+    db.conn.close()
+    return explained
+
+
+def explain(db, label, sql, params, sorts=True):
+    depths = {0: -1}
+    plan = []
+    warnings = []
+    # Sorts that are not flagged as warnings, because sorts is False
+    unflagged_sorts = []
+    for id, parent, _, detail in db.execute("explain query plan " + sql, params):
+        depths[id] = depths.get(parent, -1) + 1
+        plan.append("  " * depths[id] + detail)
+        if detail.startswith("USE TEMP B-TREE"):
+            (warnings if sorts else unflagged_sorts).append(detail)
+        elif detail == "SCAN search_index":
+            # Reading an index in order is fine, reading the whole table is not
+            warnings.append(detail)
+    return {
+        "label": label,
+        "sql": sql,
+        "plan": plan,
+        "warnings": warnings,
+        "unflagged_sorts": unflagged_sorts,
+    }
@@ -0,0 +1,112 @@
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+import time
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# How many of the most recent durations to keep for each stage
+WINDOW = 1000
+
+_current_timer = contextvars.ContextVar("dogsheep_beta_timer", default=None)
+
+
+class RequestTimer:
+    "Total time spent in each stage while handling a single request"
+
+    def __init__(self):
+        self.durations = {}
+
+    def add(self, stage, seconds):
+        self.durations[stage] = self.durations.get(stage, 0) + seconds
+
+    def server_timing(self):
+        return ", ".join(
+            "{};dur={:.1f}".format(stage, seconds * 1000)
+            for stage, seconds in self.durations.items()
+        )
+
+
+class Stats:
+    "Rolling window of recent durations for each stage, across all requests"
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.counts = {}
+        self.durations = {}
+
+    def add(self, stage, seconds):
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+        if stage not in self.durations:
+            self.durations[stage] = deque(maxlen=self.window)
+        self.durations[stage].append(seconds)
+
+    def summary(self):
+        return {
+            stage: dict(
+                summarize(list(durations)),
+                count=self.counts[stage],
+                histogram=histogram(durations),
+            )
+            for stage, durations in sorted(self.durations.items())
+        }
+
+
+stats = Stats()
+
+
+def start_request():
+    "Start timing stages for the current request, returning its RequestTimer"
+    timer = RequestTimer()
+    _current_timer.set(timer)
+    return timer
+
+
+def record(stage, seconds, type_=None):
+    stats.add(stage, seconds)
+    if type_ is not None:
+        stats.add("{}:{}".format(stage, type_), seconds)
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.add(stage, seconds)
+
+
+@contextmanager
+def timed(stage, type_=None):
+    # Also works around awaits, since asyncio tasks inherit the context
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, type_)
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        "n": len(timings),
+        "mean_ms": 1000 * sum(timings) / len(timings),
+        "p50_ms": 1000 * percentile(timings, 50),
+        "p95_ms": 1000 * percentile(timings, 95),
+        "p99_ms": 1000 * percentile(timings, 99),
+        "max_ms": 1000 * timings[-1],
+    }
+
+
+def percentile(sorted_values, percent):
+    # Nearest-rank method
+    index = max(0, -(-len(sorted_values) * percent // 100) - 1)
+    return sorted_values[int(index)]
+
+
+def histogram(durations):
+    buckets = {str(bound): 0 for bound in BUCKETS_MS}
+    buckets["+Inf"] = 0
+    for seconds in durations:
+        for bound in BUCKETS_MS:
+            if seconds * 1000 <= bound:
+                buckets[str(bound)] += 1
+                break
+        else:
+            buckets["+Inf"] += 1
+    return buckets
@@ -1,5 +1,12 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 import json
+import os
+import re
+import sqlite3
 import sqlite_utils
+import tempfile
+import time
 import yaml
 
 COLUMNS = {
@@ -13,12 +20,131 @@ COLUMNS = {
     "search_2": str,
     "search_3": str,
 }
-INDEXES = [("timestamp",), ("category",), ("is_public",)]
+# Each filter is paired with timestamp, so filtered timelines can be read in
+# order from the index rather than sorted afterwards
+INDEXES = [
+    ("timestamp",),
+    ("type", "timestamp"),
+    ("category", "timestamp"),
+    ("is_public", "timestamp"),
+]
+# Created by older versions, now covered by the indexes above
+OLD_INDEXES = ["idx_search_index_category", "idx_search_index_is_public"]
 FOREIGN_KEYS = [("category", "categories", "id")]
 DEFAULTS = {"is_public": 0}
 NOT_NULL = {
     "is_public",
 }
+FTS_COLUMNS = ["title", "search_1", "search_2", "search_3"]
+FTS_TRIGGERS = {"search_index_ai", "search_index_ad", "search_index_au"}
+# The same triggers sqlite-utils creates for enable_fts(create_triggers=True)
+FTS_TRIGGERS_SQL = """
+CREATE TRIGGER IF NOT EXISTS [search_index_ai] AFTER INSERT ON [search_index] BEGIN
+  INSERT INTO [search_index_fts] (rowid, {columns}) VALUES (new.rowid, {new});
+END;
+CREATE TRIGGER IF NOT EXISTS [search_index_ad] AFTER DELETE ON [search_index] BEGIN
+  INSERT INTO [search_index_fts] ([search_index_fts], rowid, {columns})
+  VALUES ('delete', old.rowid, {old});
+END;
+CREATE TRIGGER IF NOT EXISTS [search_index_au] AFTER UPDATE ON [search_index] BEGIN
+  INSERT INTO [search_index_fts] ([search_index_fts], rowid, {columns})
+  VALUES ('delete', old.rowid, {old});
+  INSERT INTO [search_index_fts] (rowid, {columns}) VALUES (new.rowid, {new});
+END;
+"""
+# The update trigger removes the old row if it was in this partition, then
+# adds the new one if it is - so rows move between partitions correctly
+PARTITION_TRIGGERS_SQL = """
+CREATE TRIGGER IF NOT EXISTS [{table}_ai] AFTER INSERT ON [search_index]
+WHEN {new_year} = '{year}' BEGIN
+  INSERT INTO [{table}] (rowid, {columns}) VALUES (new.rowid, {new});
+END;
+CREATE TRIGGER IF NOT EXISTS [{table}_ad] AFTER DELETE ON [search_index]
+WHEN {old_year} = '{year}' BEGIN
+  INSERT INTO [{table}] ([{table}], rowid, {columns})
+  VALUES ('delete', old.rowid, {old});
+END;
+CREATE TRIGGER IF NOT EXISTS [{table}_au] AFTER UPDATE ON [search_index] BEGIN
+  INSERT INTO [{table}] ([{table}], rowid, {columns})
+  SELECT 'delete', old.rowid, {old} WHERE {old_year} = '{year}';
+  INSERT INTO [{table}] (rowid, {columns})
+  SELECT new.rowid, {new} WHERE {new_year} = '{year}';
+END;
+"""
+# Prefix lengths indexed by FTS5 for --autocomplete, see
+# https://www.sqlite.org/fts5.html#prefix_indexes
+AUTOCOMPLETE_PREFIX = "2 3 4"
+# Tokenizer for the words suggested as completions - no stemming, and accents
+# are kept so words are suggested as they were written
+TERMS_TOKENIZE = "unicode61 remove_diacritics 0"
+# Seconds before an incremental run rebuilds the table of terms
+TERMS_MAX_AGE = 60 * 60
+PRUNE_CHUNK_SIZE = 500
+MAINTENANCE_MODES = ["auto", "none", "light", "full"]
+# FTS5 settings used by light maintenance, see https://www.sqlite.org/fts5.html
+FTS_AUTOMERGE = 8
+FTS_CRISISMERGE = 16
+FTS_MERGE_PAGES = 1000
+FTS_MAX_MERGES = 100
+# Thresholds above which auto maintenance runs a full optimize and VACUUM
+VACUUM_FREE_RATIO = 0.25
+MAX_FTS_SEGMENTS = 64
+# The year a row belongs to, for indexes partitioned by year
+YEAR_SQL = (
+    "case when {0}.timestamp glob '[0-9][0-9][0-9][0-9]*' "
+    "then substr({0}.timestamp, 1, 4) else 'undated' end"
+)
+# The day a row belongs to - the date its timestamp starts with, ignoring any
+# UTC offset, so it agrees with the string ranges used to filter by date
+DAY_SQL = (
+    "case when {0}.timestamp glob '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*' "
+    "then substr({0}.timestamp, 1, 10) end"
+)
+# Number of indexed rows for each combination of these, so the plugin can
+# calculate counts and facets without scanning the whole index
+SUMMARY_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS search_index_summary_ai AFTER INSERT ON search_index
+BEGIN
+  {increment}
+END;
+CREATE TRIGGER IF NOT EXISTS search_index_summary_ad AFTER DELETE ON search_index
+BEGIN
+  {decrement}
+END;
+CREATE TRIGGER IF NOT EXISTS search_index_summary_au AFTER UPDATE ON search_index
+BEGIN
+  {decrement}
+  {increment}
+END;
+"""
+SUMMARY_TRIGGER_NAMES = {
+    "search_index_summary_ai",
+    "search_index_summary_ad",
+    "search_index_summary_au",
+}
+SUMMARY_MATCH = (
+    "type is {0}.type and category is {0}.category "
+    "and is_public is {0}.is_public and day is " + DAY_SQL
+)
+SUMMARY_INCREMENT = """
+  UPDATE search_index_summary SET count = count + 1 WHERE {match};
+  INSERT INTO search_index_summary (type, category, is_public, day, count)
+  SELECT new.type, new.category, new.is_public, {day}, 1
+  WHERE NOT EXISTS (SELECT 1 FROM search_index_summary WHERE {match});
+""".format(match=SUMMARY_MATCH.format("new"), day=DAY_SQL.format("new"))
+SUMMARY_DECREMENT = """
+  UPDATE search_index_summary SET count = count - 1 WHERE {match};
+  DELETE FROM search_index_summary WHERE {match} AND count <= 0;
+""".format(match=SUMMARY_MATCH.format("old"))
+# Seconds between progress reports while a type is being indexed
+PROGRESS_INTERVAL = 10.0
+# Only estimate the rows for a type if count(*) takes less than this
+COUNT_TIME_LIMIT = 1.0
+# Page cache for connections that write to the index - negative values are
+# in KiB, so this is 64MB
+INDEX_CACHE_SIZE = -64 * 1024
+# run_indexer(swap=True) builds the new index in a file with this suffix
+SWAP_SUFFIX = ".new"
 
 CATEGORIES = [
     {"id": 1, "name": "created"},
@@ -27,51 +153,1020 @@ CATEGORIES = [
 ]
 
 
-def run_indexer(db_path, rules, tokenize="porter", databases=None):
+def run_indexer(
+    db_path,
+    rules,
+    tokenize="porter",
+    databases=None,
+    incremental=False,
+    prune=False,
+    workers=1,
+    fts_columns=None,
+    progress=None,
+    maintenance="auto",
+    partition=None,
+    autocomplete=None,
+    batch_size=None,
+    resume=False,
+    swap=False,
+):
+    # Returns IndexStats.to_dict() - progress is called with a dict of
+    # details as rows are indexed, see IndexStats.report(). resume continues
+    # an interrupted full run from its checkpoints. swap builds a new index
+    # alongside db_path, then replaces db_path with it once it is verified.
+    # fts_columns, partition and autocomplete keep the layout of an existing
+    # index if they are None - pass partition=False or autocomplete=False
+    # to remove partitions or prefix indexes.
+    stats = IndexStats(progress)
+    layout = index_layout(db_path)
+    if not fts_columns:
+        fts_columns = layout["fts_columns"]
+    if partition is None:
+        partition = layout["partition"]
+    if autocomplete is None:
+        autocomplete = layout["autocomplete"]
+    partition = partition or None
+    prefix = AUTOCOMPLETE_PREFIX if autocomplete else None
+    live_path = db_path
+    if swap:
+        db_path = str(live_path) + SWAP_SUFFIX
+        if not resume:
+            remove_database_files(db_path)
+    db = sqlite_utils.Database(db_path)
+    schema_version = db.execute("PRAGMA schema_version").fetchone()[0]
+    with stats.phase("setup"):
+        ensure_table_and_indexes(db, tokenize, fts_columns, partition, prefix)
+    if not incremental:
+        with db.conn:
+            start_bulk_load(db)
+            if not resume:
+                db.execute("DELETE FROM search_index_checkpoints")
+    elif bulk_loading(db):
+        # A full run was interrupted - finish it before adding to the index
+        with db.conn:
+            finish_bulk_load(db, tokenize, fts_columns, partition, prefix, stats)
+    db.conn.close()
+
+    selected = [
+        (db_name, type_rules)
+        for db_name, type_rules in rules.items()
+        if not databases or db_name in databases
+    ]
+    use_workers = workers and workers > 1
+    if use_workers:
+        jobs = [
+            (db_name, type_, info)
+            for db_name, type_rules in selected
+            for type_, info in type_rules.items()
+        ]
+        index_in_workers(db_path, jobs, workers, incremental, stats)
+
+    pruned = 0
+    if not use_workers or prune:
+        # We connect to each database in turn and attach our index
+        for db_name, type_rules in selected:
+            other_db = sqlite_utils.Database(db_name)
+            other_db.conn.execute("ATTACH DATABASE '{}' AS index1".format(db_path))
+            tune_connection(other_db.conn, "index1")
+            for type_, info in type_rules.items():
+                if not use_workers:
+                    index_type(
+                        other_db,
+                        db_name,
+                        type_,
+                        info,
+                        incremental,
+                        stats,
+                        batch_size,
+                        resume,
+                    )
+                if prune:
+                    with stats.phase("prune"):
+                        pruned += prune_type(other_db, db_name, type_, info)
+            other_db.conn.close()
+
+    db = sqlite_utils.Database(db_path)
+    tune_connection(db.conn)
+    with db.conn:
+        if not incremental:
+            finish_bulk_load(db, tokenize, fts_columns, partition, prefix, stats)
+        elif partition:
+            # Partitions for any new years
+            with stats.phase("fts_rebuild"):
+                update_partitions(db, tokenize, fts_columns, prefix=prefix)
+        if autocomplete:
+            if not incremental or terms_are_stale(db):
+                with stats.phase("terms"):
+                    rebuild_terms(db)
+        else:
+            db.execute("DROP TABLE IF EXISTS search_index_terms")
+        if not incremental:
+            # Every type is indexed, so there is nothing left to resume
+            db.execute("DELETE FROM search_index_checkpoints")
+        # Incremental runs that found nothing new, such as most runs of watch,
+        # leave the index and its generation alone
+        changed = (
+            not incremental
+            or pruned
+            or stats.to_dict()["rows"]
+            or db.execute("PRAGMA schema_version").fetchone()[0] != schema_version
+        )
+        if changed:
+            bump_generation(db)
+    if changed:
+        stats.maintenance = run_maintenance(db, maintenance, stats)
+    if swap:
+        with stats.phase("verify"):
+            verify_index(db)
+        # The -wal and -shm files belong to a path rather than a file, so
+        # only a database without them can safely be renamed
+        db.execute("PRAGMA journal_mode = delete")
+    db.conn.close()
+    if swap:
+        with stats.phase("swap"):
+            swap_index(db_path, live_path)
+    return stats.to_dict()
+
+
+class VerificationError(Exception):
+    pass
+
+
+def verify_index(db):
+    # Checks a newly built index before swapping it into place, raising
+    # VerificationError describing any problems
+    problems = []
+    result = db.execute("PRAGMA quick_check").fetchone()[0]
+    if result != "ok":
+        problems.append("quick_check: {}".format(result))
+    documents = 0
+    for table in fts_tables(db):
+        try:
+            db.execute(
+                "INSERT INTO [{0}]([{0}]) VALUES ('integrity-check')".format(table)
+            )
+        except sqlite3.DatabaseError as e:
+            problems.append("{}: {}".format(table, e))
+        documents += db.execute(
+            "select count(*) from [{}_docsize]".format(table)
+        ).fetchone()[0]
+    rows = db["search_index"].count
+    summary_rows = db.execute(
+        "select coalesce(sum(count), 0) from search_index_summary"
+    ).fetchone()[0]
+    if documents != rows:
+        problems.append(
+            "full-text index has {} rows, search_index has {}".format(documents, rows)
+        )
+    if summary_rows != rows:
+        problems.append(
+            "search_index_summary counts {} rows, search_index has {}".format(
+                summary_rows, rows
+            )
+        )
+    if problems:
+        raise VerificationError("; ".join(problems))
+
+
+def swap_index(build_path, db_path):
+    # Atomically replaces db_path with the index at build_path. Connections
+    # that already have db_path open carry on reading the old file until they
+    # reopen it, which the Datasette plugin does when it sees the new inode.
+    if os.path.exists(db_path):
+        # Move everything in the old file's WAL into the file itself, so the
+        # new file is not paired with any of it
+        conn = sqlite3.connect(db_path)
+        busy = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+        conn.close()
+        if busy:
+            raise sqlite3.OperationalError(
+                "Could not checkpoint {}, the new index has been left in {}".format(
+                    db_path, build_path
+                )
+            )
+    os.replace(build_path, db_path)
+
+
+def remove_database_files(path):
+    for suffix in ("", "-journal", "-wal", "-shm"):
+        if os.path.exists(str(path) + suffix):
+            os.remove(str(path) + suffix)
+
+
+def run_maintenance(db, mode="auto", stats=None):
+    """
+    Tidy up the index after it has been modified. Returns the mode that was
+    used, which for "auto" is "light" or "full" depending on fragmentation.
+
+    - none: do nothing
+    - light: run FTS5 merge steps and reclaim free pages with incremental_vacuum
+    - full: merge the FTS index into a single segment and VACUUM the file
+    """
+    stats = stats or IndexStats()
+    if mode == "auto":
+        mode = "full" if needs_full_maintenance(db) else "light"
+    if mode == "light":
+        with stats.phase("merge"):
+            fts_merge(db)
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            with stats.phase("incremental_vacuum"):
+                # Frees one page each time sqlite3 steps the statement, which
+                # executescript() does until it is finished
+                db.conn.executescript("PRAGMA incremental_vacuum")
+    elif mode == "full":
+        with stats.phase("optimize"), db.conn:
+            for table in fts_tables(db):
+                db.execute("INSERT INTO [{0}]([{0}]) VALUES ('optimize')".format(table))
+        with stats.phase("vacuum"):
+            # Converts indexes created by older versions to auto_vacuum too
+            db.execute("PRAGMA auto_vacuum = incremental")
+            db.vacuum()
+    return mode
+
+
+def needs_full_maintenance(db):
+    page_count = db.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = db.execute("PRAGMA freelist_count").fetchone()[0]
+    if page_count and freelist_count / page_count > VACUUM_FREE_RATIO:
+        return True
+    return fts_segment_count(db) > MAX_FTS_SEGMENTS
+
+
+def fts_segment_count(db):
+    return sum(
+        db.execute(
+            "select count(distinct segid) from [{}_idx]".format(table)
+        ).fetchone()[0]
+        for table in fts_tables(db)
+    )
+
+
+def fts_merge(db):
+    for table in fts_tables(db):
+        fts_merge_table(db, table)
+
+
+def fts_merge_table(db, table):
+    # Incrementally merge FTS5 segments, stopping once a merge step finds
+    # nothing left to do - it changes less than two rows in that case
+    command = "INSERT INTO [{0}]([{0}], rank) VALUES (?, ?)".format(table)
+    with db.conn:
+        db.execute(command, ["automerge", FTS_AUTOMERGE])
+        db.execute(command, ["crisismerge", FTS_CRISISMERGE])
+    for _ in range(FTS_MAX_MERGES):
+        before = db.conn.total_changes
+        with db.conn:
+            db.execute(command, ["merge", FTS_MERGE_PAGES])
+        if db.conn.total_changes - before < 2:
+            break
+
+
+def fts_tables(db):
+    # The full-text index, or each of its partitions
+    return list(partition_tables(db).values()) or ["search_index_fts"]
+
+
+def partition_tables(db):
+    "Returns {year: table name} for an index partitioned by year"
+    return {
+        name[len("search_index_fts_") :].lstrip("y"): name
+        for (name,) in db.execute(
+            "select name from sqlite_master where type = 'table' "
+            "and sql like 'CREATE VIRTUAL TABLE%' and ("
+            "name glob 'search_index_fts_y[0-9][0-9][0-9][0-9]' "
+            "or name = 'search_index_fts_undated')"
+        )
+    }
+
+
+def partition_table_name(year):
+    return "search_index_fts_{}".format("undated" if year == "undated" else "y" + year)
+
+
+def update_partitions(db, tokenize, fts_columns=None, rebuild=False, prefix=None):
+    # Creates a full-text index for each year found in search_index that does
+    # not have one yet, or repopulates all of them if rebuild is set
+    fts_columns = list(fts_columns or FTS_COLUMNS)
+    existing = partition_tables(db)
+    years = [
+        row[0]
+        for row in db.execute(
+            "select distinct {} from search_index".format(
+                YEAR_SQL.format("search_index")
+            )
+        )
+    ]
+    for year in years:
+        if year in existing and not rebuild:
+            continue
+        table = partition_table_name(year)
+        if year not in existing:
+            create_partition(db, table, year, tokenize, fts_columns, prefix)
+        else:
+            db.execute("INSERT INTO [{0}]([{0}]) VALUES ('delete-all')".format(table))
+        db.execute(
+            "INSERT INTO [{table}] (rowid, {columns}) "
+            "SELECT rowid, {columns} FROM search_index WHERE {year} = ?".format(
+                table=table,
+                columns=", ".join("[{}]".format(c) for c in fts_columns),
+                year=YEAR_SQL.format("search_index"),
+            ),
+            [year],
+        )
+    for year, table in existing.items():
+        if year not in years:
+            drop_partition(db, table)
+
+
+def create_partition(db, table, year, tokenize, fts_columns, prefix=None):
+    db.execute(
+        "CREATE VIRTUAL TABLE [{}] USING FTS5 ({}, content=[search_index]{}{})".format(
+            table,
+            fts_column_list(fts_columns),
+            ", tokenize='{}'".format(tokenize) if tokenize else "",
+            ", prefix='{}'".format(prefix) if prefix else "",
+        )
+    )
+    create_partition_triggers(db, table, year, fts_columns)
+
+
+def create_partition_triggers(db, table, year, fts_columns):
+    db.executescript(
+        PARTITION_TRIGGERS_SQL.format(
+            table=table,
+            year=year,
+            columns=fts_column_list(fts_columns),
+            new=fts_column_values("new", fts_columns),
+            old=fts_column_values("old", fts_columns),
+            new_year=YEAR_SQL.format("new"),
+            old_year=YEAR_SQL.format("old"),
+        )
+    )
+
+
+def create_fts_triggers(db, fts_columns):
+    db.executescript(
+        FTS_TRIGGERS_SQL.format(
+            columns=fts_column_list(fts_columns),
+            new=fts_column_values("new", fts_columns),
+            old=fts_column_values("old", fts_columns),
+        )
+    )
+
+
+def fts_column_list(fts_columns):
+    return ", ".join("[{}]".format(c) for c in fts_columns)
+
+
+def fts_column_values(alias, fts_columns):
+    return ", ".join("{}.[{}]".format(alias, c) for c in fts_columns)
+
+
+def start_bulk_load(db):
+    # Full runs rebuild the full-text index and summary once all the rows are
+    # loaded, so updating them row by row as they are inserted is wasted work.
+    # Recorded in search_index_meta so a run that is interrupted can be
+    # finished later.
+    db.execute(
+        "REPLACE INTO search_index_meta (key, value) VALUES ('bulk_load', 1)"
+    )
+    for table in FTS_TRIGGERS | SUMMARY_TRIGGER_NAMES:
+        db.execute("DROP TRIGGER IF EXISTS [{}]".format(table))
+    for table in partition_tables(db).values():
+        for suffix in ("ai", "ad", "au"):
+            db.execute("DROP TRIGGER IF EXISTS [{}_{}]".format(table, suffix))
+
+
+def bulk_loading(db):
+    return bool(
+        db.execute(
+            "select count(*) from search_index_meta where key = 'bulk_load'"
+        ).fetchone()[0]
+    )
+
+
+def finish_bulk_load(
+    db, tokenize, fts_columns=None, partition=None, prefix=None, stats=None
+):
+    # Rebuilds the full-text index and summary from search_index, then puts
+    # back the triggers that keep them up to date for incremental runs
+    stats = stats or IndexStats()
+    with stats.phase("fts_rebuild"):
+        if partition:
+            update_partitions(db, tokenize, fts_columns, rebuild=True, prefix=prefix)
+            for year, table in partition_tables(db).items():
+                columns = [column.name for column in db[table].columns]
+                create_partition_triggers(db, table, year, columns)
+        else:
+            db.execute(
+                "INSERT INTO search_index_fts(search_index_fts) VALUES ('rebuild')"
+            )
+            columns = [column.name for column in db["search_index_fts"].columns]
+            create_fts_triggers(db, columns)
+    with stats.phase("summary_rebuild"):
+        rebuild_summary(db)
+        create_summary_triggers(db)
+    db.execute("DELETE FROM search_index_meta WHERE key = 'bulk_load'")
+
+
+def index_layout(db_path):
+    # The fts_columns, partition and autocomplete options the index at
+    # db_path was built with, or the defaults if there is no index yet
+    layout = {"fts_columns": None, "partition": None, "autocomplete": False}
+    if not os.path.exists(db_path):
+        return layout
     db = sqlite_utils.Database(db_path)
-    ensure_table_and_indexes(db, tokenize)
+    partitions = partition_tables(db)
+    if partitions:
+        table = next(iter(partitions.values()))
+        layout["partition"] = "year"
+    elif db["search_index_fts"].exists():
+        table = "search_index_fts"
+    else:
+        db.conn.close()
+        return layout
+    layout["fts_columns"] = [column.name for column in db[table].columns]
+    layout["autocomplete"] = fts_prefix(db, table) is not None
     db.conn.close()
+    return layout
+
+
+def fts_prefix(db, table):
+    # The prefix= option a full-text table was created with, if any
+    sql = db.execute(
+        "select sql from sqlite_master where name = ?", [table]
+    ).fetchone()[0]
+    match = re.search(r"prefix='([^']*)'", sql)
+    return match.group(1) if match else None
+
+
+def drop_partition(db, table):
+    for suffix in ("ai", "ad", "au"):
+        db.execute("DROP TRIGGER IF EXISTS [{}_{}]".format(table, suffix))
+    db.execute("DROP TABLE IF EXISTS [{}]".format(table))
+
+
+class IndexStats:
+    "Time spent in each phase of indexing, and the rows indexed for each type"
+
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.types = {}
+        self.maintenance = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
 
-    # We connect to each database in turn and attach our index
-    for i, (db_name, type_rules) in enumerate(rules.items()):
+    def add_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def rate(self):
+        # Rows per second across the types indexed so far
+        seconds = sum(info["seconds"] for info in self.types.values())
+        rows = sum(info["rows"] for info in self.types.values())
+        return rows / seconds if seconds and rows else None
+
+    def report(self, type_key, seconds, total=None, rows=None):
+        # rows is None until the type has finished indexing - the ETA is
+        # estimated from total (if known) and the rate of earlier types
+        if self.progress is None:
+            return
+        eta = None
+        rate = self.rate()
+        if rows is None and total is not None and rate:
+            eta = max(total / rate - seconds, 0)
+        self.progress(
+            {
+                "type": type_key,
+                "rows": rows,
+                "total": total,
+                "seconds": seconds,
+                "eta": eta,
+            }
+        )
+
+    def type_done(self, type_key, rows, seconds):
+        self.types[type_key] = {
+            "rows": rows,
+            "seconds": seconds,
+            "rows_per_second": rows / seconds if seconds else None,
+        }
+        self.report(type_key, seconds, rows=rows)
+
+    @contextmanager
+    def heartbeat(self, conn, type_key, start, total=None):
+        # Reports progress every PROGRESS_INTERVAL seconds during a statement
+        if self.progress is None:
+            yield
+            return
+        next_report = [time.perf_counter() + PROGRESS_INTERVAL]
+
+        def handler():
+            now = time.perf_counter()
+            if now >= next_report[0]:
+                next_report[0] = now + PROGRESS_INTERVAL
+                self.report(type_key, now - start, total)
+            return 0
+
+        conn.set_progress_handler(handler, 100000)
+        try:
+            yield
+        finally:
+            conn.set_progress_handler(None, 0)
+
+    def to_dict(self):
+        rows = sum(info["rows"] for info in self.types.values())
+        seconds = time.perf_counter() - self.start
+        return {
+            "rows": rows,
+            "seconds": seconds,
+            "rows_per_second": rows / seconds if seconds else None,
+            "phases": self.phases,
+            "types": self.types,
+            "maintenance": self.maintenance,
+        }
+
+
+def run_pruner(db_path, rules, databases=None):
+    "Delete indexed rows that are no longer returned by their type's SQL query"
+    deleted = 0
+    for db_name, type_rules in rules.items():
         if databases and db_name not in databases:
             continue
         other_db = sqlite_utils.Database(db_name)
         other_db.conn.execute("ATTACH DATABASE '{}' AS index1".format(db_path))
         for type_, info in type_rules.items():
-            # Execute SQL with limit 0 to figure out the columns
-            sql = info["sql"]
-            # Bit of a hack - we replace the starting `select ` with one
-            # that also includes the hard-coded type
-            sql_rest = sql.split("select", 1)[1]
-            sql = "select '{}/{}' as type,{}".format(db_name, type_, sql_rest)
-            columns = derive_columns(other_db, sql)
-            with other_db.conn:
-                other_db.conn.execute(
-                    "REPLACE INTO index1.search_index ({}) {}".format(
-                        ", ".join("[{}]".format(column) for column in columns), sql
-                    )
-                )
+            deleted += prune_type(other_db, db_name, type_, info)
         other_db.conn.close()
+    if deleted:
+        db = sqlite_utils.Database(db_path)
+        with db.conn:
+            bump_generation(db)
+        db.conn.close()
+    return deleted
+
+
+def type_sql(db_name, type_, info):
+    # Bit of a hack - we replace the starting `select ` with one
+    # that also includes the hard-coded type
+    sql_rest = info["sql"].split("select", 1)[1]
+    return "select '{}/{}' as type,{}".format(db_name, type_, sql_rest)
+
+
+def index_type(
+    db,
+    db_name,
+    type_,
+    info,
+    incremental=False,
+    stats=None,
+    batch_size=None,
+    resume=False,
+):
+    # db is the source database, with the index attached as index1. If
+    # batch_size is set, rows are committed in batches of roughly that many -
+    # by since column for incremental runs of types that have one, otherwise
+    # by key. Full runs record a checkpoint with each commit, which resume
+    # continues from.
+    stats = stats or IndexStats()
+    type_key = "{}/{}".format(db_name, type_)
+    start = time.perf_counter()
+    last_since = None
+    after = None
+    since = info.get("since")
+    by_since = bool(incremental and since)
+    if by_since:
+        last_since = read_since(db.conn, "index1", type_key)
+    if not incremental and resume:
+        checkpoint = read_checkpoint(db.conn, type_key)
+        if checkpoint and checkpoint["done"]:
+            stats.type_done(type_key, 0, time.perf_counter() - start)
+            return
+        after = checkpoint["after"] if checkpoint else None
+    batch_column = (since if by_since else "key") if batch_size else None
+    total = None
+    rows = 0
+    # Later batches start after a cutoff committed by this run
+    inclusive = True
+    while True:
+        with stats.phase("derive_columns"):
+            sql, params, columns = type_query(
+                db, db_name, type_, info, last_since, inclusive
+            )
+        if after is not None:
+            sql = "select * from ({}) where [key] > :after".format(sql)
+            params = dict(params, after=after)
+        if stats.progress is not None and not rows:
+            with stats.phase("count"):
+                total = count_rows(db.conn, sql, params)
+            stats.report(type_key, time.perf_counter() - start, total)
+        cutoff = None
+        if batch_column:
+            cutoff = batch_cutoff(db.conn, batch_column, sql, params, batch_size)
+            if cutoff is not None:
+                sql = "select * from ({}) where [{}] <= :cutoff".format(
+                    sql, batch_column
+                )
+                params = dict(params, cutoff=cutoff)
+        with db.conn:
+            with stats.phase("insert"), stats.heartbeat(
+                db.conn, type_key, start, total
+            ):
+                cursor = db.conn.execute(
+                    insert_sql(
+                        "index1.search_index", columns, sql, upsert=incremental
+                    ),
+                    params,
+                )
+            # Read in the same transaction, so this matches what was inserted
+            high_water = read_high_water(db.conn, info, sql, params)
+            if high_water is not None:
+                # Batches by key can come in any order of since
+                save_since(
+                    db.conn, "index1", type_key, high_water, keep_max=after is not None
+                )
+            if not incremental:
+                save_checkpoint(db.conn, type_key, cutoff, done=cutoff is None)
+        rows += cursor.rowcount
+        if cutoff is None:
+            break
+        if by_since:
+            last_since = high_water
+            inclusive = False
+        else:
+            after = cutoff
+    stats.type_done(type_key, rows, time.perf_counter() - start)
 
-    # Rebuild FTS index (triggers don't fire for cross-database inserts)
-    # and optimize
+
+def batch_cutoff(conn, column, sql, params, batch_size):
+    # The column value of the batch_size-th row, or None if there are fewer
+    # rows than that. Rows sharing this value all go in the same batch, so
+    # the next batch can start after it without missing any
+    row = conn.execute(
+        "select [{0}] from ({1}) order by [{0}] limit 1 offset :offset".format(
+            column, sql
+        ),
+        dict(params, offset=batch_size - 1),
+    ).fetchone()
+    return row[0] if row else None
+
+
+def read_checkpoint(conn, type_key):
+    row = conn.execute(
+        "select after, done from index1.search_index_checkpoints where type = ?",
+        [type_key],
+    ).fetchone()
+    return {"after": row[0], "done": bool(row[1])} if row else None
+
+
+def save_checkpoint(conn, type_key, after, done=False):
+    # after is the last key committed, or None once the type is finished
+    conn.execute(
+        "REPLACE INTO index1.search_index_checkpoints (type, after, done) "
+        "VALUES (?, ?, ?)",
+        [type_key, after, int(done)],
+    )
+
+
+def tune_connection(conn, schema="main"):
+    # Settings for a connection that writes to the index. With WAL mode,
+    # synchronous = NORMAL can only lose the latest commits on power failure,
+    # which a resumed or incremental run will redo anyway
+    conn.execute("PRAGMA [{}].synchronous = NORMAL".format(schema))
+    conn.execute("PRAGMA [{}].cache_size = {}".format(schema, INDEX_CACHE_SIZE))
+
+
+def count_rows(conn, sql, params, time_limit=COUNT_TIME_LIMIT):
+    # Returns the number of rows sql returns, or None if that is slow to find out
+    deadline = time.perf_counter() + time_limit
+    conn.set_progress_handler(lambda: time.perf_counter() > deadline, 1000)
+    try:
+        return conn.execute(
+            "select count(*) from ({})".format(sql), params
+        ).fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.set_progress_handler(None, 0)
+
+
+def index_in_workers(db_path, jobs, workers, incremental=False, stats=None):
+    # Each (db_name, type_, info) job is extracted into its own staging
+    # database by a worker process, then merged into the index here
+    stats = stats or IndexStats()
+    start = time.perf_counter()
     db = sqlite_utils.Database(db_path)
+    tune_connection(db.conn)
+    staging_dir = tempfile.TemporaryDirectory(
+        prefix="dogsheep-beta-", dir=os.path.dirname(os.path.abspath(db_path))
+    )
+    with staging_dir, ProcessPoolExecutor(workers) as executor:
+        futures = []
+        for i, (db_name, type_, info) in enumerate(jobs):
+            last_since = None
+            if incremental and info.get("since"):
+                last_since = read_since(
+                    db.conn, "main", "{}/{}".format(db_name, type_)
+                )
+            staging_path = os.path.join(staging_dir.name, "{}.db".format(i))
+            futures.append(
+                executor.submit(
+                    extract_type, db_name, type_, info, last_since, staging_path
+                )
+            )
+        for future in as_completed(futures):
+            type_key, staging_path, columns, high_water, timings = future.result()
+            for name, seconds in timings.items():
+                stats.add_time(name, seconds)
+            db.conn.execute("ATTACH DATABASE ? AS staging", [staging_path])
+            with db.conn, stats.phase("merge"):
+                cursor = db.conn.execute(
+                    insert_sql(
+                        "search_index",
+                        columns,
+                        "select * from staging.search_index",
+                        upsert=incremental,
+                    )
+                )
+                if high_water is not None:
+                    save_since(db.conn, "main", type_key, high_water)
+            db.conn.execute("DETACH DATABASE staging")
+            os.remove(staging_path)
+            # Types run in parallel, so this is the time since indexing started
+            stats.type_done(type_key, cursor.rowcount, time.perf_counter() - start)
+    db.conn.close()
+
+
+def extract_type(db_name, type_, info, last_since, staging_path):
+    # Runs in a worker process
+    stats = IndexStats()
+    db = sqlite_utils.Database(db_name)
+    db.conn.execute("ATTACH DATABASE ? AS staging", [staging_path])
+    with stats.phase("derive_columns"):
+        sql, params, columns = type_query(db, db_name, type_, info, last_since)
+    column_list = ", ".join("[{}]".format(column) for column in columns)
+    with db.conn, stats.phase("extract"):
+        db.conn.execute("CREATE TABLE staging.search_index ({})".format(column_list))
+        db.conn.execute(
+            "INSERT INTO staging.search_index SELECT {} FROM ({})".format(
+                column_list, sql
+            ),
+            params,
+        )
+        high_water = read_high_water(db.conn, info, sql, params)
+    db.conn.close()
+    return (
+        "{}/{}".format(db_name, type_),
+        staging_path,
+        columns,
+        high_water,
+        stats.phases,
+    )
+
+
+def type_query(db, db_name, type_, info, last_since=None, inclusive=True):
+    # Returns (sql, params, columns) for the rows to be indexed for this type,
+    # where columns are the columns of that SQL to store in search_index.
+    # Rows equal to last_since are included by default, as rows sharing the
+    # high-water value may have been committed after it was read - the
+    # upsert leaves the ones that were already indexed alone.
+    sql = type_sql(db_name, type_, info)
+    since = info.get("since")
+    params = {}
+    if since and last_since is not None:
+        sql = "select * from ({}) where [{}] {} :since".format(
+            sql, since, ">=" if inclusive else ">"
+        )
+        params["since"] = last_since
+    # Execute SQL with limit 0 to figure out the columns - the since
+    # column is allowed to be one that is not stored in the index
+    columns = [
+        column
+        for column in derive_columns(db, sql, params)
+        if column != since or column in COLUMNS
+    ]
+    return sql, params, columns
+
+
+def insert_sql(table, columns, sql, upsert=False):
+    column_list = ", ".join("[{}]".format(column) for column in columns)
+    if not upsert:
+        return "REPLACE INTO {} ({columns}) SELECT {columns} FROM ({})".format(
+            table, sql, columns=column_list
+        )
+    # An upsert fires the FTS update triggers for just the changed rows
+    # (the WHERE true avoids a parsing ambiguity with ON CONFLICT). Rows
+    # that are identical to what is already indexed are left alone.
+    updated = [column for column in columns if column not in ("type", "key")]
+    if not updated:
+        return (
+            "INSERT INTO {} ({columns}) SELECT {columns} FROM ({}) WHERE true "
+            "ON CONFLICT (type, key) DO NOTHING"
+        ).format(table, sql, columns=column_list)
+    return (
+        "INSERT INTO {} ({columns}) SELECT {columns} FROM ({}) WHERE true "
+        "ON CONFLICT (type, key) DO UPDATE SET {updates} "
+        "WHERE ({existing}) IS NOT ({excluded})"
+    ).format(
+        table,
+        sql,
+        columns=column_list,
+        updates=", ".join(
+            "[{0}] = excluded.[{0}]".format(column) for column in updated
+        ),
+        existing=", ".join("[{}]".format(column) for column in updated),
+        excluded=", ".join("excluded.[{}]".format(column) for column in updated),
+    )
+
+
+def read_since(conn, schema, type_key):
+    row = conn.execute(
+        "select since from {}.search_index_state where type = ?".format(schema),
+        [type_key],
+    ).fetchone()
+    return row[0] if row else None
+
+
+def save_since(conn, schema, type_key, since, keep_max=False):
+    if keep_max:
+        sql = (
+            "INSERT INTO {}.search_index_state (type, since) VALUES (?, ?) "
+            "ON CONFLICT (type) DO UPDATE SET since = max(since, excluded.since)"
+        )
+    else:
+        sql = "REPLACE INTO {}.search_index_state (type, since) VALUES (?, ?)"
+    conn.execute(sql.format(schema), [type_key, since])
+
+
+def read_high_water(conn, info, sql, params):
+    if not info.get("since"):
+        return None
+    return conn.execute(
+        "select max([{}]) from ({})".format(info["since"], sql), params
+    ).fetchone()[0]
+
+
+def prune_type(db, db_name, type_, info, chunk_size=PRUNE_CHUNK_SIZE):
+    # db is the source database, with the index attached as index1
+    type_key = "{}/{}".format(db_name, type_)
+    sql = type_sql(db_name, type_, info)
+    # Anti-join against a temporary table of the keys the source still has
+    db.conn.execute("drop table if exists temp.source_keys")
+    db.conn.execute("create temp table source_keys (key text primary key)")
     with db.conn:
         db.conn.execute(
-            'INSERT INTO search_index_fts(search_index_fts) VALUES ("rebuild")'
+            "insert or ignore into temp.source_keys select [key] from ({})".format(sql)
         )
-        db["search_index"].optimize()
-    db.vacuum()
+    rowids = [
+        row[0]
+        for row in db.conn.execute(
+            "select rowid from index1.search_index where type = ? "
+            "and key not in (select key from temp.source_keys)",
+            [type_key],
+        )
+    ]
+    db.conn.execute("drop table temp.source_keys")
+    # Delete in chunks to avoid holding the write lock for too long - the
+    # delete trigger removes each row from the FTS index as well
+    for i in range(0, len(rowids), chunk_size):
+        chunk = rowids[i : i + chunk_size]
+        with db.conn:
+            db.conn.execute(
+                "delete from index1.search_index where rowid in ({})".format(
+                    ", ".join("?" for _ in chunk)
+                ),
+                chunk,
+            )
+    return len(rowids)
 
 
-def derive_columns(db, sql):
-    cursor = db.conn.execute(sql + " limit 0")
+def create_summary_triggers(db):
+    db.executescript(
+        SUMMARY_TRIGGERS.format(
+            increment=SUMMARY_INCREMENT, decrement=SUMMARY_DECREMENT
+        )
+    )
+
+
+def stale_summary_triggers(db):
+    return bool(
+        db.execute(
+            "select 1 from sqlite_master where type = 'trigger' "
+            "and name = 'search_index_summary_ai' and sql like '%date(new.timestamp)%'"
+        ).fetchall()
+    )
+
+
+def rebuild_summary(db):
+    db.execute("DELETE FROM search_index_summary")
+    db.execute(
+        "INSERT INTO search_index_summary (type, category, is_public, day, count) "
+        "SELECT type, category, is_public, {}, count(*) "
+        "FROM search_index GROUP BY 1, 2, 3, 4".format(DAY_SQL.format("search_index"))
+    )
+
+
+def rebuild_terms(db):
+    # The number of documents containing each word in the full-text columns,
+    # used to suggest completions for search terms. The full-text index only
+    # has stems if the porter tokenizer was used, so the words are counted
+    # using a temporary index that keeps them as they were written.
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS search_index_terms "
+        "(term TEXT PRIMARY KEY, documents INTEGER) WITHOUT ROWID"
+    )
+    db.execute("DELETE FROM search_index_terms")
+    tables = [table for table in fts_tables(db) if db[table].exists()]
+    if not tables:
+        return
+    columns = fts_column_list(column.name for column in db[tables[0]].columns)
+    db.execute(
+        "CREATE VIRTUAL TABLE temp.search_index_words USING fts5 "
+        "({}, content='', tokenize='{}')".format(columns, TERMS_TOKENIZE)
+    )
+    db.execute(
+        "INSERT INTO temp.search_index_words (rowid, {0}) "
+        "SELECT rowid, {0} FROM search_index".format(columns)
+    )
+    db.execute(
+        "CREATE VIRTUAL TABLE temp.search_index_vocab "
+        "USING fts5vocab(temp, 'search_index_words', 'row')"
+    )
+    db.execute(
+        "INSERT INTO search_index_terms (term, documents) "
+        "SELECT term, doc FROM temp.search_index_vocab"
+    )
+    db.execute("DROP TABLE temp.search_index_vocab")
+    db.execute("DROP TABLE temp.search_index_words")
+    db.execute(
+        "REPLACE INTO search_index_meta (key, value) VALUES ('terms_built', ?)",
+        [time.time()],
+    )
+
+
+def terms_are_stale(db, max_age=TERMS_MAX_AGE):
+    # Incremental runs, including each change picked up by watch, only
+    # rebuild the terms if they are missing or older than max_age seconds
+    if not db["search_index_terms"].exists():
+        return True
+    row = db.execute(
+        "select value from search_index_meta where key = 'terms_built'"
+    ).fetchone()
+    return row is None or time.time() - row[0] > max_age
+
+
+def bump_generation(db):
+    # Lets the Datasette plugin know that cached results are now stale.
+    # Based on the current time so a deleted and rebuilt index never
+    # repeats a generation number that was used before.
+    db.execute(
+        "insert into search_index_meta (key, value) values ('generation', :now) "
+        "on conflict (key) do update set value = max(value + 1, :now)",
+        {"now": int(time.time() * 1000)},
+    )
+
+
+def get_generation(conn):
+    row = conn.execute(
+        "select value from search_index_meta where key = 'generation'"
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def derive_columns(db, sql, params=None):
+    cursor = db.conn.execute(sql + " limit 0", params or {})
     return [r[0] for r in cursor.description]
 
 
-def ensure_table_and_indexes(db, tokenize):
+def ensure_table_and_indexes(
+    db, tokenize, fts_columns=None, partition=None, prefix=None
+):
+    fts_columns = list(fts_columns or FTS_COLUMNS)
+    if not db.table_names():
+        # Lets light maintenance reclaim free pages without a full VACUUM
+        db.execute("PRAGMA auto_vacuum = incremental")
+    # Lets Datasette keep reading the index while it is being written to
+    db.execute("PRAGMA journal_mode = wal")
     db["categories"].insert_all(CATEGORIES, pk="id", replace=True)
+    db.execute(
+        "create table if not exists search_index_meta (key text primary key, value)"
+    )
+    # High-water marks for types that can be indexed incrementally
+    db.execute(
+        "create table if not exists search_index_state (type text primary key, since)"
+    )
+    # Progress through each type during a full run, for --resume
+    db.execute(
+        "create table if not exists search_index_checkpoints "
+        "(type text primary key, after, done integer)"
+    )
     table = db["search_index"]
     if not table.exists():
         table.create(
@@ -79,6 +1174,7 @@ def ensure_table_and_indexes(db, tokenize):
             pk=("type", "key"),
             not_null=NOT_NULL,
             defaults=DEFAULTS,
+            foreign_keys=FOREIGN_KEYS,
         )
     else:
         # Ensure all the column exists
@@ -86,15 +1182,77 @@ def ensure_table_and_indexes(db, tokenize):
         for key, type_ in COLUMNS.items():
             if key not in existing_columns:
                 table.add_column(key, type_, not_null_default=DEFAULTS.get(key))
-    if not db["search_index_fts"].exists():
-        table.enable_fts(["title", "search_1"], create_triggers=True, tokenize=tokenize)
+        # This can recreate the table, so must happen before the FTS triggers
+        for fk in FOREIGN_KEYS:
+            try:
+                table.add_foreign_key(*fk)
+            except sqlite_utils.db.AlterError:
+                pass
+    fts = db["search_index_fts"]
+    partitions = partition_tables(db)
+    if partition == "year":
+        # Partitions are created by update_partitions() once rows are indexed
+        if fts.exists():
+            table.disable_fts()
+        if partitions:
+            first = next(iter(partitions.values()))
+            if [column.name for column in db[first].columns] != fts_columns or (
+                fts_prefix(db, first) != prefix
+            ):
+                for partition_table in partitions.values():
+                    drop_partition(db, partition_table)
+    else:
+        for partition_table in partitions.values():
+            drop_partition(db, partition_table)
+        if not fts.exists():
+            table.enable_fts(fts_columns, create_triggers=True, tokenize=tokenize)
+        elif [column.name for column in fts.columns] != fts_columns or not (
+            FTS_TRIGGERS.issubset(table.triggers_dict) or bulk_loading(db)
+        ):
+            # The FTS columns have changed, or the triggers were lost when an
+            # older version's add_foreign_key() recreated the table - so
+            # re-create it
+            table.enable_fts(
+                fts_columns, create_triggers=True, tokenize=tokenize, replace=True
+            )
+        if fts_prefix(db, "search_index_fts") != prefix:
+            # sqlite-utils cannot create prefix indexes, so replace the
+            # virtual table - the triggers on search_index still apply to it
+            db.execute("DROP TABLE search_index_fts")
+            db.execute(
+                "CREATE VIRTUAL TABLE [search_index_fts] USING FTS5 "
+                "({}, content=[search_index]{}{})".format(
+                    ", ".join("[{}]".format(c) for c in fts_columns),
+                    ", tokenize='{}'".format(tokenize) if tokenize else "",
+                    ", prefix='{}'".format(prefix) if prefix else "",
+                )
+            )
+            db.execute(
+                "INSERT INTO search_index_fts(search_index_fts) VALUES ('rebuild')"
+            )
     for index in INDEXES:
         table.create_index(index, if_not_exists=True)
-    for fk in FOREIGN_KEYS:
-        try:
-            table.add_foreign_key(*fk)
-        except sqlite_utils.db.AlterError:
-            pass
+    for index_name in OLD_INDEXES:
+        db.execute("DROP INDEX IF EXISTS [{}]".format(index_name))
+    if not db["search_index_summary"].exists():
+        db.execute(
+            "CREATE TABLE search_index_summary (type TEXT, category INTEGER, "
+            "is_public INTEGER, day TEXT, count INTEGER)"
+        )
+        db.execute(
+            "CREATE INDEX search_index_summary_group "
+            "ON search_index_summary (type, category, is_public, day)"
+        )
+        with db.conn:
+            rebuild_summary(db)
+    elif stale_summary_triggers(db):
+        # Indexes built before days ignored UTC offsets
+        with db.conn:
+            for name in SUMMARY_TRIGGER_NAMES:
+                db.execute("DROP TRIGGER IF EXISTS [{}]".format(name))
+            rebuild_summary(db)
+    if not bulk_loading(db):
+        create_summary_triggers(db)
 
 
 class BadMetadataError(Exception):
@@ -0,0 +1,132 @@
+import os
+import sqlite3
+import time
+import urllib.request
+from .utils import parse_metadata, run_indexer
+
+POLL_INTERVAL = 1.0
+# Wait for a database to stop changing for this long before indexing it...
+DEBOUNCE = 2.0
+# ...unless it has been changing continuously for this long
+MAX_DELAY = 30.0
+BATCH_SIZE = 1000
+
+
+class DatabaseWatcher:
+    "Detects changes to a database file without reading any of its tables"
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.inode = None
+        self.signature = None
+
+    def changed(self):
+        """
+        Returns True if the database has changed since the last call. Commits
+        by any other connection change PRAGMA data_version, and a new inode
+        means the file has been replaced, for example by a fresh download.
+        """
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            self.close()
+            signature = None
+        else:
+            if inode != self.inode:
+                self.close()
+                # Read-only, as all this needs is PRAGMA data_version
+                uri = "file:{}?mode=ro".format(urllib.request.pathname2url(self.path))
+                self.conn = sqlite3.connect(uri, uri=True)
+                self.inode = inode
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            signature = (inode, data_version)
+        changed = signature != self.signature
+        self.signature = signature
+        return changed
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+        self.inode = None
+
+
+def run_watcher(
+    db_path,
+    config_path,
+    databases=None,
+    interval=POLL_INTERVAL,
+    debounce=DEBOUNCE,
+    batch_size=BATCH_SIZE,
+    on_index=None,
+    stop=None,
+    **indexer_options,
+):
+    """
+    Keep db_path up to date with the source databases in config_path, until
+    stop (a threading.Event) is set. Each database is re-indexed incrementally
+    once it has stopped changing for debounce seconds, then on_index is called
+    with a dict of the databases, stats and any error.
+    """
+    config_mtime = None
+    watchers = {}
+    # db_name => (time of first unindexed change, time of latest change)
+    pending = {}
+    while stop is None or not stop.is_set():
+        now = time.monotonic()
+        mtime = os.stat(config_path).st_mtime_ns
+        if mtime != config_mtime:
+            # Started, or the config file has been edited - index everything
+            # straight away, picking up any changes made while not watching
+            config_mtime = mtime
+            with open(config_path) as fp:
+                rules = parse_metadata(fp.read())
+            for watcher in watchers.values():
+                watcher.close()
+            watchers = {
+                db_name: DatabaseWatcher(db_name)
+                for db_name in rules
+                if not databases or db_name in databases
+            }
+            for watcher in watchers.values():
+                watcher.changed()
+            pending = {db_name: (now, now - debounce) for db_name in watchers}
+        for db_name, watcher in watchers.items():
+            if watcher.changed():
+                pending[db_name] = (pending.get(db_name, (now,))[0], now)
+        ready = [
+            db_name
+            for db_name, (first, last) in pending.items()
+            # Wait for a database that has gone missing to come back
+            if watchers[db_name].signature is not None
+            and (now - last >= debounce or now - first >= MAX_DELAY)
+        ]
+        if ready:
+            event = {"databases": ready, "stats": None, "error": None}
+            try:
+                event["stats"] = run_indexer(
+                    db_path,
+                    rules,
+                    databases=ready,
+                    incremental=True,
+                    batch_size=batch_size,
+                    **indexer_options,
+                )
+            except sqlite3.OperationalError as e:
+                # Probably locked by whatever is writing to it - try again
+                # after another debounce interval
+                event["error"] = e
+                for db_name in ready:
+                    pending[db_name] = (pending[db_name][0], now)
+            else:
+                for db_name in ready:
+                    del pending[db_name]
+            if on_index is not None:
+                on_index(event)
+        if stop is None:
+            time.sleep(interval)
+        else:
+            stop.wait(interval)
+    for watcher in watchers.values():
+        watcher.close()
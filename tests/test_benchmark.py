@@ -0,0 +1,44 @@
+from click.testing import CliRunner
+from dogsheep_beta.benchmark import generate_corpus
+from dogsheep_beta.cli import cli
+import json
+import sqlite_utils
+
+
+def test_generate_corpus(tmp_path):
+    rules = generate_corpus(str(tmp_path), databases=2, rows=50)
+    assert list(rules) == ["source_0.db", "source_1.db"]
+    db = sqlite_utils.Database(tmp_path / "source_1.db")
+    assert db["items"].count == 50
+    # Same seed, same corpus
+    first = list(db["items"].rows)
+    db.conn.close()
+    generate_corpus(str(tmp_path), databases=2, rows=50)
+    db = sqlite_utils.Database(tmp_path / "source_1.db")
+    assert list(db["items"].rows) == first
+
+
+def test_benchmark_command(tmp_path):
+    output = tmp_path / "results.json"
+    result = CliRunner().invoke(
+        cli,
+        [
+            "benchmark",
+            str(tmp_path / "corpus"),
+            "--rows",
+            "100",
+            "--iterations",
+            "3",
+            "-o",
+            str(output),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "rows/sec" in result.output
+    results = json.loads(output.read_text())
+    assert results["indexing"]["rows"] == 200
+    assert set(results["queries"]) == {"timeline", "search", "faceted", "display"}
+    for timings in results["queries"].values():
+        assert timings["n"] == 3
+        assert timings["errors"] == 0
+        assert timings["p50_ms"] <= timings["p99_ms"]
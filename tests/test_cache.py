@@ -0,0 +1,50 @@
+from dogsheep_beta.cache import GenerationCache, LRUCache
+import sqlite3
+import time
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_bytes=10)
+    cache.set("a", "1234")
+    cache.set("b", "1234")
+    assert cache.get("a") == "1234"
+    # Pushes the size over the limit, so "b" is evicted
+    cache.set("c", "1234")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1234"
+    assert cache.get("c") == "1234"
+    assert cache.size == 8
+    # Values bigger than the whole cache are not stored
+    cache.set("d", "12345678901")
+    assert cache.get("d") is None
+    assert len(cache) == 2
+
+
+def test_generation_cache(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = GenerationCache(1024, path)
+    cache.set(1, ["q", "dog"], {"count": 3})
+    assert cache.get(1, ["q", "dog"]) == {"count": 3}
+    # A different generation misses
+    assert cache.get(2, ["q", "dog"]) is None
+    # A second process can read from the shared SQLite file
+    other = GenerationCache(1024, path)
+    assert other.get(1, ["q", "dog"]) == {"count": 3}
+    # Writing a new generation clears out the old entries on disk
+    other.set(2, ["q", "cat"], {"count": 1})
+    assert other.disk.conn.execute("select count(*) from cache").fetchone()[0] == 1
+
+
+def test_sqlite_cache_does_not_wait_for_locks(tmp_path):
+    path = str(tmp_path / "cache.db")
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("begin exclusive")
+    disk = GenerationCache(1024, path).disk
+    start = time.perf_counter()
+    # Locked by another process - a miss, and nothing is stored
+    disk.set("key", "value", 1)
+    assert disk.get("key") is None
+    assert time.perf_counter() - start < 0.5
+    other.execute("rollback")
+    disk.set("key", "value", 1)
+    assert disk.get("key") == "value"
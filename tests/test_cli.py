@@ -1,7 +1,10 @@
 from click.testing import CliRunner
 from dogsheep_beta.cli import cli
+from dogsheep_beta.utils import get_generation, run_maintenance
 import sqlite_utils
 import datetime
+import json
+import os
 import textwrap
 import pytest
 
@@ -99,7 +102,15 @@ def test_basic(tmp_path_factory, monkeypatch, use_porter):
         },
     ]
     indexes = sorted([i.columns for i in beta_db["search_index"].indexes])
-    assert indexes == sorted([["is_public"], ["category"], ["timestamp"], ["type", "key"]])
+    assert indexes == sorted(
+        [
+            ["timestamp"],
+            ["type", "timestamp"],
+            ["category", "timestamp"],
+            ["is_public", "timestamp"],
+            ["type", "key"],
+        ]
+    )
 
     # Test that search works, with porter stemming
     results = list(beta_db["search_index"].search("run"))
@@ -120,3 +131,651 @@ def test_basic(tmp_path_factory, monkeypatch, use_porter):
         ]
     else:
         assert results == []
+
+
+def test_incremental(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = sqlite_utils.Database(tmp_path / "dogs.db")
+    db["dogs"].insert_all(
+        [
+            {"id": 1, "name": "Cleo", "likes": "running"},
+            {"id": 2, "name": "Pancakes", "likes": "chasing"},
+        ],
+        pk="id",
+    )
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        textwrap.dedent(
+            """
+    dogs.db:
+        dogs:
+            since: id
+            sql: |-
+                select id, id as key, name as title, likes as search_1 from dogs
+    """
+        ),
+        "utf-8",
+    )
+    beta_path = str(tmp_path / "beta.db")
+    runner = CliRunner()
+    result = runner.invoke(cli, ["index", beta_path, str(config_path)])
+    assert result.exit_code == 0, result.output
+    beta_db = sqlite_utils.Database(beta_path)
+    assert list(beta_db["search_index_state"].rows) == [
+        {"type": "dogs.db/dogs", "since": 2}
+    ]
+    # Rows below the high-water mark are not re-read
+    db["dogs"].update(1, {"likes": "sleeping"})
+    db["dogs"].insert({"id": 3, "name": "Bailey", "likes": "running"})
+    result = runner.invoke(
+        cli, ["index", beta_path, str(config_path), "--incremental"]
+    )
+    assert result.exit_code == 0, result.output
+    assert [
+        (r["key"], r["search_1"]) for r in beta_db["search_index"].rows
+    ] == [("1", "running"), ("2", "chasing"), ("3", "running")]
+    assert list(beta_db["search_index_state"].rows) == [
+        {"type": "dogs.db/dogs", "since": 3}
+    ]
+    # The new row was added to the FTS index without a rebuild
+    assert [r["key"] for r in beta_db["search_index"].search("running")] == [
+        "1",
+        "3",
+    ]
+    # Re-indexing an existing key updates its FTS entry in place
+    beta_db["search_index_state"].update("dogs.db/dogs", {"since": 0})
+    result = runner.invoke(
+        cli, ["index", beta_path, str(config_path), "--incremental"]
+    )
+    assert result.exit_code == 0, result.output
+    assert [r["key"] for r in beta_db["search_index"].search("running")] == ["3"]
+    assert [r["key"] for r in beta_db["search_index"].search("sleeping")] == ["1"]
+
+
+@pytest.mark.parametrize("use_index_option", [True, False])
+def test_prune(tmp_path, monkeypatch, use_index_option):
+    monkeypatch.chdir(tmp_path)
+    db = sqlite_utils.Database(tmp_path / "dogs.db")
+    db["dogs"].insert_all(
+        [
+            {"id": 1, "name": "Cleo", "likes": "running"},
+            {"id": 2, "name": "Pancakes", "likes": "running"},
+            {"id": 3, "name": "Bailey", "likes": "running"},
+        ],
+        pk="id",
+    )
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        textwrap.dedent(
+            """
+    dogs.db:
+        dogs:
+            sql: |-
+                select id as key, name as title, likes as search_1 from dogs
+    """
+        ),
+        "utf-8",
+    )
+    beta_path = str(tmp_path / "beta.db")
+    runner = CliRunner()
+    result = runner.invoke(cli, ["index", beta_path, str(config_path)])
+    assert result.exit_code == 0, result.output
+    db["dogs"].delete(2)
+    if use_index_option:
+        result = runner.invoke(
+            cli, ["index", beta_path, str(config_path), "--incremental", "--prune"]
+        )
+        assert result.exit_code == 0, result.output
+    else:
+        result = runner.invoke(cli, ["prune", beta_path, str(config_path)])
+        assert result.exit_code == 0, result.output
+        assert result.output == "Deleted 1 row\n"
+    beta_db = sqlite_utils.Database(beta_path)
+    assert [r["key"] for r in beta_db["search_index"].rows] == ["1", "3"]
+    assert [r["key"] for r in beta_db["search_index"].search("running")] == [
+        "1",
+        "3",
+    ]
+    # Deleted from the FTS index too, not just the content table
+    assert beta_db["search_index_fts_docsize"].count == 2
+
+
+def test_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ("dogs", "cats"):
+        sqlite_utils.Database(tmp_path / "{}.db".format(name))[name].insert_all(
+            [
+                {"id": i, "name": "{} {}".format(name, i), "likes": "running"}
+                for i in range(1, 51)
+            ],
+            pk="id",
+        )
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        textwrap.dedent(
+            """
+    dogs.db:
+        dogs:
+            since: id
+            sql: select id, id as key, name as title, likes as search_1 from dogs
+    cats.db:
+        cats:
+            sql: select id as key, name as title, likes as search_1 from cats
+        kittens:
+            sql: select id as key, name as title from cats where id < 10
+    """
+        ),
+        "utf-8",
+    )
+    runner = CliRunner()
+    for beta, extra in (("serial.db", []), ("parallel.db", ["--workers", "3"])):
+        result = runner.invoke(cli, ["index", beta, str(config_path)] + extra)
+        assert result.exit_code == 0, result.output
+
+    def indexed(path):
+        db = sqlite_utils.Database(tmp_path / path)
+        return (
+            sorted(
+                (r["type"], r["key"], r["title"]) for r in db["search_index"].rows
+            ),
+            list(db["search_index_state"].rows),
+            len(list(db["search_index"].search("running"))),
+        )
+
+    assert indexed("parallel.db") == indexed("serial.db")
+    rows, state, matches = indexed("parallel.db")
+    assert len(rows) == 109
+    assert state == [{"type": "dogs.db/dogs", "since": 50}]
+    assert matches == 100
+    # Staging databases are cleaned up
+    assert not [p for p in os.listdir(tmp_path) if p.startswith("dogsheep-beta-")]
+    # Incremental mode works with workers too
+    sqlite_utils.Database(tmp_path / "dogs.db")["dogs"].insert(
+        {"id": 51, "name": "dogs 51", "likes": "running"}
+    )
+    result = runner.invoke(
+        cli,
+        ["index", "parallel.db", str(config_path), "--workers", "2", "--incremental"],
+    )
+    assert result.exit_code == 0, result.output
+    rows, state, matches = indexed("parallel.db")
+    assert len(rows) == 110
+    assert state == [{"type": "dogs.db/dogs", "since": 51}]
+    assert matches == 101
+
+
+def test_fts_columns(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sqlite_utils.Database(tmp_path / "dogs.db")["dogs"].insert(
+        {"id": 1, "name": "Cleo", "likes": "running", "hates": "baths"}, pk="id"
+    )
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "dogs.db:\n    dogs:\n        sql: |-\n            select id as key, "
+        "name as title, likes as search_1, hates as search_2 from dogs\n",
+        "utf-8",
+    )
+    runner = CliRunner()
+
+    def index(*args):
+        result = runner.invoke(cli, ["index", "beta.db", str(config_path)] + list(args))
+        assert result.exit_code == 0, result.output
+        beta_db = sqlite_utils.Database(tmp_path / "beta.db")
+        return (
+            [c.name for c in beta_db["search_index_fts"].columns],
+            len(list(beta_db["search_index"].search("baths"))),
+            set(beta_db["search_index"].triggers_dict),
+        )
+
+    # Limit to specific columns
+    columns, matches, triggers = index("--fts-column", "title", "--fts-column", "search_1")
+    assert columns == ["title", "search_1"]
+    assert matches == 0
+    # Later runs keep the existing columns unless they are given again
+    columns, matches, triggers = index("--incremental")
+    assert columns == ["title", "search_1"]
+    assert matches == 0
+    all_columns = ["title", "search_1", "search_2", "search_3"]
+    columns, matches, triggers = index(
+        "--incremental", *(arg for c in all_columns for arg in ("--fts-column", c))
+    )
+    assert columns == all_columns
+    assert matches == 1
+    assert triggers == {
+        "search_index_ai",
+        "search_index_ad",
+        "search_index_au",
+        "search_index_summary_ai",
+        "search_index_summary_ad",
+        "search_index_summary_au",
+    }
+
+
+def test_layout_kept(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sqlite_utils.Database(tmp_path / "dogs.db")["dogs"].insert(
+        {"id": 1, "name": "Cleo", "day": "2020-01-01"}, pk="id"
+    )
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "dogs.db:\n    dogs:\n        sql: |-\n"
+        "            select id as key, name as title, day as timestamp from dogs\n",
+        "utf-8",
+    )
+
+    def index(*args):
+        result = CliRunner().invoke(
+            cli, ["index", "beta.db", str(config_path)] + list(args)
+        )
+        assert result.exit_code == 0, result.output
+        beta_db = sqlite_utils.Database(tmp_path / "beta.db")
+        return sorted(
+            (name, "prefix=" in sql)
+            for name, sql in beta_db.execute(
+                "select name, sql from sqlite_master "
+                "where name glob 'search_index_fts*' and sql like 'CREATE VIRTUAL%'"
+            )
+        ), beta_db["search_index_terms"].exists()
+
+    partitioned = ([("search_index_fts_y2020", True)], True)
+    assert index("--partition-by-year", "--autocomplete") == partitioned
+    # Runs without the options keep the partitions and prefix indexes...
+    assert index("--incremental") == partitioned
+    assert index() == partitioned
+    # ...until they are turned off
+    assert index("--incremental", "--no-autocomplete") == (
+        [("search_index_fts_y2020", False)],
+        False,
+    )
+    assert index("--no-partition-by-year") == ([("search_index_fts", False)], False)
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_progress_and_stats_json(tmp_path, monkeypatch, workers):
+    monkeypatch.chdir(tmp_path)
+    sqlite_utils.Database(tmp_path / "dogs.db")["dogs"].insert_all(
+        [{"id": i, "name": "Dog {}".format(i)} for i in range(1, 21)], pk="id"
+    )
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "dogs.db:\n    dogs:\n        sql: select id as key, name as title from dogs\n"
+        "    puppies:\n        sql: select id as key, name as title from dogs "
+        "where id < 5\n",
+        "utf-8",
+    )
+    stats_path = tmp_path / "stats.json"
+    result = CliRunner().invoke(
+        cli,
+        [
+            "index",
+            "beta.db",
+            str(config_path),
+            "--progress",
+            "--stats-json",
+            str(stats_path),
+            "--workers",
+            str(workers),
+            "--maintenance",
+            "full",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "dogs.db/dogs: 20 rows in " in result.output
+    assert "dogs.db/puppies: 4 rows in " in result.output
+    assert "Indexed 24 rows in " in result.output
+    stats = json.loads(stats_path.read_text())
+    assert stats["rows"] == 24
+    assert {key: info["rows"] for key, info in stats["types"].items()} == {
+        "dogs.db/dogs": 20,
+        "dogs.db/puppies": 4,
+    }
+    expected_phases = {"derive_columns", "fts_rebuild", "optimize", "vacuum"}
+    assert expected_phases.issubset(stats["phases"])
+    assert stats["maintenance"] == "full"
+
+
+@pytest.mark.parametrize(
+    "maintenance,expected_phases",
+    (
+        ("none", set()),
+        ("light", {"merge", "incremental_vacuum"}),
+        ("full", {"optimize", "vacuum"}),
+        ("auto", {"merge", "incremental_vacuum"}),
+    ),
+)
+def test_maintenance(tmp_path, monkeypatch, maintenance, expected_phases):
+    monkeypatch.chdir(tmp_path)
+    # Long enough to fill several pages, which are freed by deleting them
+    sqlite_utils.Database(tmp_path / "dogs.db")["dogs"].insert_all(
+        [
+            {"id": i, "name": "Dog {} ".format(i) + "woof " * 200}
+            for i in range(1, 21)
+        ],
+        pk="id",
+    )
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "dogs.db:\n    dogs:\n        sql: select id as key, name as title from dogs\n",
+        "utf-8",
+    )
+    stats_path = tmp_path / "stats.json"
+    result = CliRunner().invoke(
+        cli,
+        [
+            "index",
+            "beta.db",
+            str(config_path),
+            "--stats-json",
+            str(stats_path),
+            "--maintenance",
+            maintenance,
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    stats = json.loads(stats_path.read_text())
+    maintenance_phases = {"merge", "incremental_vacuum", "optimize", "vacuum"}
+    assert maintenance_phases.intersection(stats["phases"]) == expected_phases
+    beta_db = sqlite_utils.Database(tmp_path / "beta.db")
+    # New indexes use incremental auto_vacuum
+    assert beta_db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert len(list(beta_db["search_index"].search("dog"))) == 20
+    # Maintenance reclaims all the pages freed by deleting rows
+    with beta_db.conn:
+        beta_db.execute("delete from search_index where key != '1'")
+    assert beta_db.execute("PRAGMA freelist_count").fetchone()[0] > 0
+    run_maintenance(beta_db, maintenance)
+    freelist_count = beta_db.execute("PRAGMA freelist_count").fetchone()[0]
+    assert (freelist_count > 0) == (maintenance == "none")
+
+
+def test_explain(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sqlite_utils.Database(tmp_path / "dogs.db")["dogs"].insert(
+        {"id": 1, "name": "Cleo"}, pk="id"
+    )
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "dogs.db:\n    dogs:\n        sql: select id as key, name as title from dogs\n",
+        "utf-8",
+    )
+    runner = CliRunner()
+    result = runner.invoke(cli, ["index", "beta.db", str(config_path)])
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(cli, ["explain", "beta.db", "--facets"])
+    assert result.exit_code == 0, result.output
+    assert "USING INDEX idx_search_index_type_timestamp (type=?)" in result.output
+    assert "0 of 36 queries flagged for a table scan" in result.output
+    assert "18 searches or facets also use a temporary B-tree sort" in result.output
+    # Without a suitable index the results for a type have to be sorted
+    beta_db = sqlite_utils.Database(tmp_path / "beta.db")
+    beta_db.execute("drop index idx_search_index_type_timestamp")
+    beta_db.conn.close()
+    result = runner.invoke(cli, ["explain", "beta.db", "-q", "type=dogs.db/dogs"])
+    assert result.exit_code == 0, result.output
+    assert "USE TEMP B-TREE FOR ORDER BY  <-- !" in result.output
+    assert "2 of 2 queries flagged for a table scan" in result.output
+    assert "searches or facets" not in result.output
+
+
+def test_incremental_batch_size(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dogs = sqlite_utils.Database(tmp_path / "dogs.db")["dogs"]
+    # Several dogs share each day, so batches must not split a day
+    dogs.insert_all(
+        [
+            {"id": i, "name": "Dog {}".format(i), "day": "2020-01-0{}".format(i // 3)}
+            for i in range(1, 11)
+        ],
+        pk="id",
+    )
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "dogs.db:\n    dogs:\n        since: day\n        sql: |-\n"
+        "            select id as key, name as title, day from dogs\n",
+        "utf-8",
+    )
+    args = ["index", "beta.db", str(config_path), "--incremental", "--batch-size", "2"]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    beta_db = sqlite_utils.Database(tmp_path / "beta.db")
+    assert beta_db["search_index"].count == 10
+    assert list(beta_db["search_index_state"].rows) == [
+        {"type": "dogs.db/dogs", "since": "2020-01-03"}
+    ]
+    dogs.insert_all(
+        [{"id": i, "name": "Dog {}".format(i), "day": "2020-01-04"} for i in (11, 12)]
+    )
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert beta_db["search_index"].count == 12
+    assert len(list(beta_db["search_index"].search("dog"))) == 12
+    # A row committed later with the same value as the high-water mark is
+    # still picked up, and the rows already indexed are not written again
+    dogs.insert({"id": 13, "name": "Dog 13", "day": "2020-01-04"})
+    result = CliRunner().invoke(cli, args + ["--stats-json", "stats.json"])
+    assert result.exit_code == 0, result.output
+    assert beta_db["search_index"].count == 13
+    assert json.loads((tmp_path / "stats.json").read_text("utf-8"))["rows"] == 1
+
+
+def test_resume(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source = sqlite_utils.Database(tmp_path / "pets.db")
+    source["cats"].insert_all(
+        [{"id": i, "name": "Cat {}".format(i)} for i in range(1, 4)], pk="id"
+    )
+    # abs() of the smallest integer overflows, so indexing fails at dog 5
+    source["dogs"].insert_all(
+        [{"id": i, "name": "Dog {}".format(i), "n": i} for i in range(1, 9)], pk="id"
+    )
+    source["dogs"].update(5, {"n": -9223372036854775808})
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "pets.db:\n"
+        "    cats:\n"
+        "        sql: |-\n"
+        "            select id as key, name as title from cats\n"
+        "    dogs:\n"
+        "        sql: |-\n"
+        "            select id as key, name as title, abs(n) as search_1 from dogs\n",
+        "utf-8",
+    )
+    args = ["index", "beta.db", str(config_path), "--batch-size", "2"]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 1
+    assert "integer overflow" in str(result.exception)
+    beta_db = sqlite_utils.Database(tmp_path / "beta.db")
+    assert beta_db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert beta_db["search_index"].count == 7
+    assert list(beta_db["search_index_checkpoints"].rows) == [
+        {"type": "pets.db/cats", "after": None, "done": 1},
+        {"type": "pets.db/dogs", "after": 4, "done": 0},
+    ]
+    # Fix the bad row, then carry on from the checkpoints
+    source["dogs"].update(5, {"n": 5})
+    stats_path = tmp_path / "stats.json"
+    result = CliRunner().invoke(
+        cli, args + ["--resume", "--stats-json", str(stats_path)]
+    )
+    assert result.exit_code == 0, result.output
+    types = json.loads(stats_path.read_text("utf-8"))["types"]
+    assert types["pets.db/cats"]["rows"] == 0
+    assert types["pets.db/dogs"]["rows"] == 4
+    assert beta_db["search_index"].count == 11
+    assert len(list(beta_db["search_index"].search("dog"))) == 8
+    assert beta_db["search_index_checkpoints"].count == 0
+    # Resuming does not mix with incremental runs
+    result = CliRunner().invoke(cli, args + ["--resume", "--incremental"])
+    assert result.exit_code == 2
+    assert "--resume cannot be used" in result.output
+    # Nor does batching with workers
+    result = CliRunner().invoke(cli, args + ["--workers", "2"])
+    assert result.exit_code == 2
+    assert "--batch-size cannot be used with --workers" in result.output
+
+
+def test_swap(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dogs = sqlite_utils.Database(tmp_path / "dogs.db")["dogs"]
+    dogs.insert_all(
+        [{"id": i, "name": "Dog {}".format(i)} for i in range(1, 4)], pk="id"
+    )
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "dogs.db:\n    dogs:\n        sql: |-\n"
+        "            select id as key, name as title from dogs\n",
+        "utf-8",
+    )
+    args = ["index", "beta.db", str(config_path)]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    beta_path = tmp_path / "beta.db"
+    inode = os.stat(beta_path).st_ino
+    dogs.insert({"id": 4, "name": "Dog 4"})
+    result = CliRunner().invoke(cli, args + ["--swap"])
+    assert result.exit_code == 0, result.output
+    # A new file has been renamed into place, without a WAL
+    assert os.stat(beta_path).st_ino != inode
+    assert not os.path.exists(str(beta_path) + ".new")
+    beta_db = sqlite_utils.Database(beta_path)
+    assert beta_db.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    assert beta_db["search_index"].count == 4
+    assert len(list(beta_db["search_index"].search("dog"))) == 4
+    beta_db.conn.close()
+    # An index that fails verification is left where it was built
+    inode = os.stat(beta_path).st_ino
+    monkeypatch.setattr(
+        "dogsheep_beta.utils.run_maintenance",
+        lambda db, mode, stats: db.execute("delete from search_index_summary"),
+    )
+    result = CliRunner().invoke(cli, args + ["--swap"])
+    assert result.exit_code == 1
+    assert (
+        "New index failed verification: search_index_summary counts 0 rows, "
+        "search_index has 4" in result.output
+    )
+    assert os.stat(beta_path).st_ino == inode
+    assert os.path.exists(str(beta_path) + ".new")
+    # The new index has to include every database
+    result = CliRunner().invoke(cli, args + ["--swap", "-d", "dogs.db"])
+    assert result.exit_code == 2
+    assert "--swap cannot be used" in result.output
+
+
+def test_full_run_without_triggers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dogs = sqlite_utils.Database(tmp_path / "dogs.db")["dogs"]
+    dogs.insert_all(
+        [{"id": i, "name": "Dog {}".format(i), "n": i} for i in range(1, 5)], pk="id"
+    )
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "dogs.db:\n    dogs:\n        sql: |-\n"
+        "            select id as key, name as title, abs(n) as search_1 from dogs\n",
+        "utf-8",
+    )
+    args = ["index", "beta.db", str(config_path)]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    beta_db = sqlite_utils.Database(tmp_path / "beta.db")
+    assert {"search_index_ai", "search_index_ad", "search_index_au"}.issubset(
+        beta_db["search_index"].triggers_dict
+    )
+    # The triggers are dropped while a full run loads rows, so an interrupted
+    # run leaves them missing until the next run finishes the job
+    dogs.insert({"id": 5, "name": "Dog 5", "n": -9223372036854775808})
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 1
+    assert "search_index_ai" not in beta_db["search_index"].triggers_dict
+    assert "search_index_summary_ai" not in beta_db["search_index"].triggers_dict
+    dogs.update(5, {"n": 5})
+    result = CliRunner().invoke(cli, args + ["--incremental"])
+    assert result.exit_code == 0, result.output
+    assert "search_index_ai" in beta_db["search_index"].triggers_dict
+    assert "search_index_summary_ai" in beta_db["search_index"].triggers_dict
+    assert len(list(beta_db["search_index"].search("dog"))) == 5
+    assert beta_db.execute(
+        "select sum(count) from search_index_summary"
+    ).fetchone()[0] == 5
+    assert not beta_db.execute(
+        "select count(*) from search_index_meta where key = 'bulk_load'"
+    ).fetchone()[0]
+
+
+def test_incremental_skips_unchanged_rows(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dogs = sqlite_utils.Database(tmp_path / "dogs.db")["dogs"]
+    dogs.insert_all(
+        [{"id": i, "name": "Dog {}".format(i)} for i in range(1, 4)], pk="id"
+    )
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "dogs.db:\n    dogs:\n        sql: |-\n"
+        "            select id as key, name as title from dogs\n",
+        "utf-8",
+    )
+    stats_path = tmp_path / "stats.json"
+    args = [
+        "index",
+        "beta.db",
+        str(config_path),
+        "--incremental",
+        "--stats-json",
+        str(stats_path),
+    ]
+
+    def rows_indexed():
+        result = CliRunner().invoke(cli, args)
+        assert result.exit_code == 0, result.output
+        types = json.loads(stats_path.read_text("utf-8"))["types"]
+        return types["dogs.db/dogs"]["rows"]
+
+    assert rows_indexed() == 3
+    beta_db = sqlite_utils.Database(tmp_path / "beta.db")
+    generation = get_generation(beta_db.conn)
+    # Types without a since: column are read in full, but only rows that
+    # have changed are written - with nothing written, the generation (and
+    # so the plugin's cache) is left alone and maintenance is skipped
+    assert rows_indexed() == 0
+    assert get_generation(beta_db.conn) == generation
+    assert json.loads(stats_path.read_text("utf-8"))["maintenance"] is None
+    dogs.update(2, {"name": "Puppy"})
+    assert rows_indexed() == 1
+    assert get_generation(beta_db.conn) > generation
+    assert [row["key"] for row in beta_db["search_index"].search("puppy")] == ["2"]
+    assert len(list(beta_db["search_index"].search("dog"))) == 2
+
+
+def test_incremental_terms_refresh(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dogs = sqlite_utils.Database(tmp_path / "dogs.db")["dogs"]
+    dogs.insert({"id": 1, "name": "Cleo"}, pk="id")
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "dogs.db:\n    dogs:\n        since: id\n        sql: |-\n"
+        "            select id, id as key, name as title from dogs\n",
+        "utf-8",
+    )
+    args = ["index", "beta.db", str(config_path), "--autocomplete"]
+    beta_db = sqlite_utils.Database(tmp_path / "beta.db")
+
+    def terms():
+        return [row["term"] for row in beta_db["search_index_terms"].rows]
+
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert terms() == ["cleo"]
+    # Incremental runs leave recently built terms alone...
+    dogs.insert({"id": 2, "name": "Pancakes"})
+    result = CliRunner().invoke(cli, args + ["--incremental"])
+    assert result.exit_code == 0, result.output
+    assert terms() == ["cleo"]
+    # ...until they are an hour old
+    with beta_db.conn:
+        beta_db.execute(
+            "update search_index_meta set value = value - 3601 "
+            "where key = 'terms_built'"
+        )
+    result = CliRunner().invoke(cli, args + ["--incremental"])
+    assert result.exit_code == 0, result.output
+    assert terms() == ["cleo", "pancakes"]
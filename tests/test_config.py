@@ -0,0 +1,52 @@
+from dogsheep_beta.config import BetaConfig, fragment_hash, load_config
+import os
+
+
+def test_load_config_is_cached_until_file_changes(tmp_path):
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "dogs.db:\n    dogs:\n        sql: select 1\n        display: '{{ title }}'\n",
+        "utf-8",
+    )
+    config = load_config(str(config_path))
+    assert config.rules_by_type == {
+        "dogs.db/dogs": {"sql": "select 1", "display": "{{ title }}"}
+    }
+    template = config.template("dogs.db/dogs")
+    assert template.render(title="<b>") == "&lt;b&gt;"
+    # Unchanged file returns the same object and compiled template
+    assert load_config(str(config_path)) is config
+    assert config.template("dogs.db/dogs") is template
+    # Editing the file triggers a reload
+    config_path.write_text(
+        "dogs.db:\n    cats:\n        sql: select 2\n",
+        "utf-8",
+    )
+    stat = os.stat(config_path)
+    os.utime(config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+    reloaded = load_config(str(config_path))
+    assert reloaded is not config
+    assert list(reloaded.rules_by_type) == ["dogs.db/cats"]
+
+
+def test_uses_search_1():
+    assert not BetaConfig(
+        {"dogs.db": {"dogs": {"sql": "select 1", "display": "{{ title }}"}}}
+    ).uses_search_1
+    assert BetaConfig(
+        {"dogs.db": {"dogs": {"sql": "select 1", "display": "{{ search_1 }}"}}}
+    ).uses_search_1
+    # No display template means the default output, which includes search_1
+    assert BetaConfig({"dogs.db": {"dogs": {"sql": "select 1"}}}).uses_search_1
+
+
+def test_fragment_hash():
+    info = {"display": "{{ display.name }}", "display_sql": "select :key"}
+    assert fragment_hash(info) is not None
+    assert fragment_hash(info) == fragment_hash(dict(info))
+    assert fragment_hash(info) != fragment_hash(dict(info, display="{{ title }}"))
+    # Output that depends on the search term is never cached
+    assert fragment_hash(dict(info, display="{{ snippet }}")) is None
+    assert fragment_hash(dict(info, display_sql="select :key, :q")) is None
+    assert fragment_hash(dict(info, display_sql_batch="select :q")) is None
+    assert fragment_hash({"display_sql": "select :key"}) is None
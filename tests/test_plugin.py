@@ -1,14 +1,65 @@
 from datasette.app import Datasette
+from datasette.database import Database
+from datasette.utils.asgi import Request
 from bs4 import BeautifulSoup as Soup
+from dogsheep_beta import (
+    fetch_display,
+    get_count_and_facets_sql,
+    process_results,
+    search,
+    summary_filters,
+)
+from dogsheep_beta.cache import GenerationCache
 from dogsheep_beta.cli import index
-from dogsheep_beta.utils import parse_metadata
+from dogsheep_beta.config import BetaConfig
+from dogsheep_beta.utils import parse_metadata, partition_tables, run_indexer
+import asyncio
+import json
 import textwrap
 import sqlite_utils
 import pytest
 import urllib
 
 
+class FakeResults:
+    def __init__(self, row):
+        self.row = row
+
+    def first(self):
+        return self.row
+
+
+class FakeDatasette:
+    # For calling fetch_display() and process_results() directly - every
+    # database runs display_sql using the execute(sql, params) coroutine
+    def __init__(self, execute):
+        self.execute = execute
+
+    def get_database(self, name):
+        return self
+
+
+def parse_facets(html):
+    soup = Soup(html, "html5lib")
+    return [
+        {
+            "name": el.find("h2").text,
+            "values": [
+                {
+                    "selected": "selected" in li.get("class", ""),
+                    "count": int(li.select(".count")[0].text),
+                    "url": li.find("a")["href"],
+                    "label": li.select(".label")[0].text,
+                }
+                for li in el.find_all("li")
+            ],
+        }
+        for el in soup.select(".facet")
+    ]
+
+
 @pytest.mark.asyncio
+@pytest.mark.parametrize("ds", ["sql", "datasette"], indirect=True)
 async def test_search(ds):
     client = ds.client
     response = await client.get("/-/beta")
@@ -25,23 +76,7 @@ async def test_search(ds):
     ):
         assert fragment in response.text
     # Test facets
-    soup = Soup(response.text, "html5lib")
-    facet_els = soup.select(".facet")
-    facets = [
-        {
-            "name": el.find("h2").text,
-            "values": [
-                {
-                    "selected": "selected" in li.get("class", ""),
-                    "count": int(li.select(".count")[0].text),
-                    "url": li.find("a")["href"],
-                    "label": li.select(".label")[0].text,
-                }
-                for li in el.find_all("li")
-            ],
-        }
-        for el in facet_els
-    ]
+    facets = parse_facets(response.text)
     assert facets == [
         {
             "name": "type",
@@ -108,6 +143,36 @@ async def test_search(ds):
     ]
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "path",
+    (
+        "/-/beta",
+        "/-/beta?q=things",
+        "/-/beta?q=things&type=emails.db%2Femails",
+        "/-/beta?category=1",
+        "/-/beta?q=email&timestamp__date=2020-08-02&is_public=0",
+        "/-/beta?q=%23dogfest",
+    ),
+)
+async def test_facet_engines_match(ds, monkeypatch, path):
+    sql_response = await ds.client.get(path)
+    assert sql_response.status_code == 200
+    plugin_config = ds.plugin_config
+    monkeypatch.setattr(
+        ds,
+        "plugin_config",
+        lambda *args, **kwargs: dict(
+            plugin_config(*args, **kwargs), facet_engine="datasette"
+        ),
+    )
+    datasette_response = await ds.client.get(path)
+    assert datasette_response.status_code == 200
+    sql_facets = parse_facets(sql_response.text)
+    assert sql_facets
+    assert sql_facets == parse_facets(datasette_response.text)
+
+
 all_results = [
     "github.db/commits:5becbf70d64951e2910314ef5227d19b11c25b0c9586934941366da8997e57cb",
     "emails.db/emails:2",
@@ -230,6 +295,556 @@ async def test_search_order_for_timeline(ds, sort, expected):
     )
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("concurrency", [1, 3])
+async def test_fetch_display_concurrency_limit(concurrency):
+    running = []
+    max_running = []
+
+    async def execute(sql, params):
+        running.append(1)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+        return FakeResults({"key": params["key"]})
+
+    config = BetaConfig({"dogs.db": {"dogs": {"display_sql": "select :key"}}})
+    results = [{"type": "dogs.db/dogs", "key": str(i)} for i in range(6)]
+    await fetch_display(FakeDatasette(execute), results, config, "", concurrency)
+    assert [r["display"] for r in results] == [{"key": str(i)} for i in range(6)]
+    assert max(max_running) == concurrency
+
+
+@pytest.mark.asyncio
+async def test_fragment_cache():
+    queries = []
+
+    async def execute(sql, params):
+        queries.append(params["key"])
+        return FakeResults({"name": "Dog " + params["key"]})
+
+    config = BetaConfig(
+        {
+            "dogs.db": {
+                "dogs": {
+                    "display_sql": "select :key",
+                    "display": "{{ display.name }}",
+                },
+                "cats": {
+                    "display_sql": "select :key",
+                    "display": "{{ display.name }} {{ snippet }}",
+                },
+            }
+        }
+    )
+    cache = GenerationCache(1024 * 1024)
+
+    async def render(generation, *keys):
+        results = [
+            {"type": type_, "key": key, "snippet": "match"} for type_, key in keys
+        ]
+        await process_results(
+            FakeDatasette(execute),
+            results,
+            config,
+            "",
+            fragment_cache=cache,
+            generation=generation,
+        )
+        return [r["output"] for r in results]
+
+    assert await render(1, ("dogs.db/dogs", "1"), ("dogs.db/dogs", "2")) == [
+        "Dog 1",
+        "Dog 2",
+    ]
+    assert queries == ["1", "2"]
+    # Items that have been rendered before skip display_sql entirely
+    queries.clear()
+    assert await render(1, ("dogs.db/dogs", "2"), ("dogs.db/dogs", "3")) == [
+        "Dog 2",
+        "Dog 3",
+    ]
+    assert queries == ["3"]
+    # Templates using the snippet are rendered every time
+    queries.clear()
+    await render(1, ("dogs.db/cats", "1"))
+    assert await render(1, ("dogs.db/cats", "1")) == ["Dog 1 match"]
+    assert queries == ["1", "1"]
+    # Re-indexing starts again
+    queries.clear()
+    await render(2, ("dogs.db/dogs", "2"))
+    assert queries == ["2"]
+
+
+@pytest.mark.asyncio
+async def test_results_cached_until_reindexed(ds):
+    beta_path = ds.get_database("beta").path
+    response = await ds.client.get("/-/beta?q=things")
+    assert "<p>Got 3 results" in response.text
+    # Changes that bypass the indexer do not invalidate the cache
+    beta_db = sqlite_utils.Database(beta_path)
+    beta_db["search_index"].delete_where("type = 'emails.db/emails'")
+    response = await ds.client.get("/-/beta?q=things")
+    assert "<p>Got 3 results" in response.text
+    # Re-running the indexer bumps the generation
+    index.callback(beta_path, "dogsheep-beta.yml", None, ["github.db"])
+    response = await ds.client.get("/-/beta?q=things")
+    assert "<p>Got 1 result," in response.text
+
+
+@pytest.mark.asyncio
+async def test_reopens_swapped_index(ds):
+    beta_path = ds.get_database("beta").path
+    response = await ds.client.get("/-/beta?q=things")
+    assert "<p>Got 3 results" in response.text
+    sqlite_utils.Database("emails.db")["emails"].delete(2)
+    index.callback(beta_path, "dogsheep-beta.yml", None, [], swap=True)
+    response = await ds.client.get("/-/beta?q=things")
+    assert "<p>Got 2 results" in response.text
+    database = ds.get_database("beta")
+    assert database.route == "beta"
+    results = await database.execute("select count(*) from search_index")
+    assert results.first()[0] == 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "args,expected",
+    (
+        ({"timestamp__date": "2020-08-01"}, all_results[2:]),
+        ({"timestamp__year": "2020"}, all_results),
+        ({"timestamp__year": "2019"}, []),
+        ({"timestamp__month": "2020-08"}, all_results),
+        ({"timestamp__month": "2020-12"}, []),
+        ({"timestamp__gte": "2020-08-02"}, all_results[:2]),
+        ({"timestamp__lt": "2020-08-02T12"}, all_results[1:]),
+        ({"timestamp__gte": "2020-08-01T12", "q": "things"}, all_results[1:2]),
+    ),
+)
+async def test_date_filters(ds, args, expected):
+    response = await ds.client.get("/-/beta?" + urllib.parse.urlencode(args))
+    assert response.status_code == 200
+    soup = Soup(response.text, "html5lib")
+    results = [el["data-table-key"] for el in soup.select("[data-table-key]")]
+    assert results == expected
+    assert "<p>Got {} result".format(len(expected)) in response.text
+    # Date arguments are preserved by the search form
+    hiddens = {
+        el["name"]: el["value"]
+        for el in soup.select("form input[type=hidden]")
+        if el["name"] != "sort"
+    }
+    assert hiddens == {k: v for k, v in args.items() if k != "q"}
+
+
+@pytest.mark.asyncio
+async def test_date_facet_ignores_utc_offset(ds):
+    # 22:30 on the 1st at UTC-5 is the 2nd in UTC, but filters compare the
+    # timestamp as a string - so the facet has to use the date as written
+    sqlite_utils.Database(ds.get_database("beta").path)["search_index"].insert(
+        {
+            "type": "emails.db/emails",
+            "key": "3",
+            "title": "Late email",
+            "timestamp": "2020-08-01T22:30:00-05:00",
+        }
+    )
+    request = Request.fake("/-/beta?q=late")
+    count, facets = await get_count_and_facets_sql(ds, "beta", request)
+    assert count == 1
+    timestamp_facet = [f for f in facets if f["name"] == "timestamp"][0]
+    assert [r["value"] for r in timestamp_facet["results"]] == ["2020-08-01"]
+    response = await ds.client.get("/-/beta.json?q=late&timestamp__date=2020-08-01")
+    data = response.json()
+    assert data["count"] == 1
+    assert [r["key"] for r in data["results"]] == ["3"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "args",
+    (
+        {"timestamp__date": "2020-13-01"},
+        {"timestamp__month": "2020"},
+        {"timestamp__year": "last"},
+    ),
+)
+async def test_invalid_date_filters(ds, args):
+    response = await ds.client.get("/-/beta?" + urllib.parse.urlencode(args))
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "args,expected",
+    (
+        ({}, all_results + ["emails.db/emails:3"]),
+        ({"sort": "oldest"}, ["emails.db/emails:3"] + list(reversed(all_results))),
+        ({"q": "things"}, ["emails.db/emails:1", "emails.db/emails:2"] + all_results[2:3]),
+        ({"q": "things", "sort": "newest"}, all_results[1:]),
+    ),
+)
+@pytest.mark.parametrize("size", (1, 2, 3, 100))
+async def test_pagination(ds, args, expected, size):
+    # An item with no timestamp, which sorts after everything else
+    beta_db = sqlite_utils.Database(ds.get_database("beta").path)
+    beta_db["search_index"].insert(
+        {"type": "emails.db/emails", "key": "3", "title": "Undated"}
+    )
+    path = "/-/beta?" + urllib.parse.urlencode(dict(args, size=size))
+    seen = []
+    while path:
+        response = await ds.client.get(path)
+        assert response.status_code == 200
+        soup = Soup(response.text, "html5lib")
+        page = [el["data-table-key"] for el in soup.select("[data-table-key]")]
+        assert 0 < len(page) <= size
+        seen.extend(page)
+        next_link = soup.select(".next a")
+        path = next_link[0]["href"] if next_link else None
+        if path:
+            assert "size={}".format(size) in path
+    assert seen == expected
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "qs", ("size=0", "size=101", "size=many", "next=nope", "next=WzFd")
+)
+async def test_pagination_bad_request(ds, qs):
+    response = await ds.client.get("/-/beta?" + qs)
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_json(ds):
+    response = await ds.client.get("/-/beta.json?q=things&size=2")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 3
+    assert [r["key"] for r in data["results"]] == ["1", "2"]
+    assert data["results"][0]["search_1"] == "An email about things"
+    assert "output" not in data["results"][0]
+    assert data["next_url"] == "/-/beta.json?" + urllib.parse.urlencode(
+        {"q": "things", "size": 2, "next": data["next"]}
+    )
+    response = await ds.client.get(data["next_url"] + "&_output=1")
+    results = response.json()["results"]
+    assert len(results) == 1
+    assert results[0]["output"].startswith("<p>Commit to dogsheep/dogsheep-beta")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", (1, 2, 100))
+async def test_ndjson(ds, size):
+    response = await ds.client.get("/-/beta.ndjson?size={}".format(size))
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [
+        "{}:{}".format(row["type"], row["key"]) for row in rows
+    ] == all_results
+    response = await ds.client.get("/-/beta.ndjson?q=things&_output=1")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert len(rows) == 3
+    assert all(row["output"] for row in rows)
+    response = await ds.client.get("/-/beta.ndjson?next=nope")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_server_timing_and_stats(ds):
+    response = await ds.client.get("/-/beta?q=things")
+    assert response.status_code == 200
+    stages = [
+        part.split(";")[0] for part in response.headers["server-timing"].split(", ")
+    ]
+    assert set(stages) == {"search", "facets", "display_sql", "render", "template"}
+    response = await ds.client.get("/-/beta/stats")
+    assert response.status_code == 200
+    data = response.json()
+    for stage in (
+        "search",
+        "display_sql:emails.db/emails",
+        "display_sql:github.db/commits",
+        "render:github.db/commits",
+    ):
+        assert data[stage]["count"] >= 1
+        assert data[stage]["p50_ms"] <= data[stage]["p99_ms"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("title_weight", (0, 100))
+async def test_bm25_weights(ds, monkeypatch, title_weight):
+    plugin_config = ds.plugin_config
+    monkeypatch.setattr(
+        ds,
+        "plugin_config",
+        lambda *args, **kwargs: dict(
+            plugin_config(*args, **kwargs), bm25_weights={"title": title_weight}
+        ),
+    )
+    response = await ds.client.get("/-/beta?q=things+OR+commit")
+    assert response.status_code == 200
+    soup = Soup(response.text, "html5lib")
+    results = [el["data-table-key"] for el in soup.select("[data-table-key]")]
+    assert len(results) == 4
+    # This commit only matches on its title
+    title_only = all_results[0]
+    if title_weight:
+        assert title_only in results[:2]
+    else:
+        assert results[-1] == title_only
+
+
+@pytest.mark.asyncio
+async def test_snippets(ds):
+    await ds.invoke_startup()
+    request = Request.fake("/-/beta?q=email+%23dogfest")
+    results, _ = await search(
+        ds,
+        "beta",
+        request,
+        include_search_1=False,
+        snippet_options={
+            "tokens": 3,
+            "markers": ["<b>", "</b>"],
+            "highlight_column": 0,
+        },
+    )
+    assert [(r["snippet"], r["highlight"]) for r in results] == [
+        ("An <b>email</b> about…", "Hey there #<b>dogfest</b>")
+    ]
+    assert "search_1" not in results[0]
+    # Searches without a query return neither
+    results, _ = await search(ds, "beta", Request.fake("/-/beta"))
+    assert "snippet" not in results[0]
+    assert "search_1" in results[0]
+
+
+@pytest.mark.asyncio
+async def test_suggest(ds):
+    beta_path = ds.get_database("beta").path
+    rules = parse_metadata(open("dogsheep-beta.yml").read())
+
+    async def suggest(q):
+        response = await ds.client.get(
+            "/-/beta/suggest?" + urllib.parse.urlencode({"q": q})
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert not data["timed_out"]
+        return (
+            [(c["q"], c["documents"]) for c in data["completions"]],
+            sorted(t["title"] for t in data["titles"]),
+        )
+
+    # Titles work without --autocomplete, but there are no completions
+    assert await suggest("Th") == (
+        [],
+        ["Commit to dogsheep/dogsheep-beta", "Hey there #dogfest", "What's going on"],
+    )
+    assert 'list="suggestions"' not in (await ds.client.get("/-/beta")).text
+    for partition in (None, "year"):
+        run_indexer(beta_path, rules, partition=partition, autocomplete=True)
+        assert await suggest("Th") == (
+            [("things", 3), ("there", 1)],
+            [
+                "Commit to dogsheep/dogsheep-beta",
+                "Hey there #dogfest",
+                "What's going on",
+            ],
+        )
+        # Earlier words must match, the last one is completed
+        assert await suggest("another th") == (
+            [("another things", 3), ("another there", 1)],
+            ["Commit to dogsheep/dogsheep-beta", "What's going on"],
+        )
+        # Completions are words rather than stems, and match titles even
+        # when the porter stem of what has been typed does not - "adde"
+        # stems to "add", but "added" was indexed as "ad"
+        assert await suggest("anot") == (
+            [("another", 2)],
+            ["Commit to dogsheep/dogsheep-beta", "What's going on"],
+        )
+        assert await suggest("adde") == (
+            [("added", 1)],
+            ["Commit to dogsheep/dogsheep-beta"],
+        )
+        # Nothing to complete after a space
+        assert await suggest("email ") == (
+            [],
+            ["Hey there #dogfest", "What's going on"],
+        )
+        assert await suggest("") == ([], [])
+    assert 'list="suggestions"' in (await ds.client.get("/-/beta")).text
+    beta_db = sqlite_utils.Database(beta_path)
+    assert "prefix='2 3 4'" in beta_db["search_index_fts_y2020"].schema
+    beta_db.conn.close()
+    # Re-indexing with --no-autocomplete removes the prefix indexes and terms
+    run_indexer(beta_path, rules, partition=False, autocomplete=False)
+    beta_db = sqlite_utils.Database(beta_path)
+    assert "prefix=" not in beta_db["search_index_fts"].schema
+    assert not beta_db["search_index_terms"].exists()
+    assert (await suggest("Th"))[0] == []
+
+
+@pytest.mark.asyncio
+async def test_suggest_time_limit(ds, monkeypatch):
+    sqlite_utils.Database(ds.get_database("emails").path)["emails"].insert_all(
+        [
+            {"id": 3, "subject": "Old things", "body": "", "date": "2019-03-01"},
+            {"id": 4, "subject": "New things", "body": "", "date": "2021-06-01"},
+        ]
+    )
+    rules = parse_metadata(open("dogsheep-beta.yml").read())
+    run_indexer(ds.get_database("beta").path, rules, partition="year")
+    limits = []
+    execute = Database.execute
+
+    async def slow_execute(self, sql, params=None, custom_time_limit=None, **kwargs):
+        if custom_time_limit is not None:
+            limits.append(custom_time_limit)
+            await asyncio.sleep(0.03)
+        return await execute(self, sql, params, custom_time_limit, **kwargs)
+
+    monkeypatch.setattr(Database, "execute", slow_execute)
+    response = await ds.client.get("/-/beta/suggest?q=th")
+    # 50ms is shared by the query for each partition, so it runs out before
+    # all three have been searched
+    assert response.json()["timed_out"]
+    assert 1 <= len(limits) < 3
+    assert limits == sorted(limits, reverse=True)
+    assert limits[0] <= 50
+@pytest.mark.asyncio
+async def test_partitioned_index(ds):
+    emails_db = sqlite_utils.Database(ds.get_database("emails").path)
+    emails_db["emails"].insert_all(
+        [
+            {"id": 3, "subject": "Old things", "body": "", "date": "2019-03-01"},
+            {"id": 4, "subject": "New things", "body": "", "date": "2021-06-01"},
+            {"id": 5, "subject": "Undated things", "body": "", "date": None},
+        ]
+    )
+    rules = parse_metadata(open("dogsheep-beta.yml").read())
+    beta_path = ds.get_database("beta").path
+    paths = [
+        "/-/beta.json?q=things&size=2",
+        "/-/beta.json?q=things&sort=newest&size=2",
+        "/-/beta.json?q=things&sort=oldest&size=2",
+        "/-/beta.json?q=things&timestamp__year=2020",
+        "/-/beta.json?q=things&timestamp__gte=2020-08-02",
+        "/-/beta.json?q=things&timestamp__lt=2020",
+        "/-/beta.json?q=nothing",
+    ]
+
+    async def fetch_all():
+        responses = {}
+        for path in paths:
+            pages = []
+            next_url = path
+            while next_url:
+                data = (await ds.client.get(next_url)).json()
+                pages.append(
+                    (
+                        data["count"],
+                        data["facets"],
+                        [(r["type"], r["key"], r["highlight"]) for r in data["results"]],
+                    )
+                )
+                next_url = data["next_url"]
+            responses[path] = pages
+        return responses
+
+    run_indexer(beta_path, rules)
+    expected = await fetch_all()
+    run_indexer(beta_path, rules, partition="year")
+    assert set(
+        partition_tables(sqlite_utils.Database(beta_path).conn)
+    ) == {"2019", "2020", "2021", "undated"}
+    actual = await fetch_all()
+    # bm25() scores depend on the statistics of each partition, so only the
+    # timestamp sort orders are guaranteed to be the same
+    relevance = paths[0]
+    actual_pages, expected_pages = actual.pop(relevance), expected.pop(relevance)
+    assert [page[:2] for page in actual_pages] == [
+        page[:2] for page in expected_pages
+    ]
+    actual_results = [r for page in actual_pages for r in page[2]]
+    assert len(actual_results) == 6
+    assert sorted(actual_results) == sorted(
+        r for page in expected_pages for r in page[2]
+    )
+    assert actual == expected
+    newest = [r[1] for page in expected[paths[1]] for r in page[2]]
+    assert newest[:2] == ["4", "2"]
+    assert newest[-1] == "5"
+
+
+@pytest.mark.asyncio
+async def test_summary_table(ds):
+    # Changes made through the triggers, rather than a full re-index
+    beta_db = sqlite_utils.Database(ds.get_database("beta").path)
+    beta_db["search_index"].insert_all(
+        [
+            {"type": "emails.db/emails", "key": "3", "title": "Undated"},
+            {
+                "type": "emails.db/emails",
+                "key": "4",
+                "title": "Later",
+                "timestamp": "2020-08-02T10:00:00",
+                "category": 2,
+            },
+            {
+                "type": "emails.db/emails",
+                "key": "5",
+                "title": "Late",
+                "timestamp": "2020-08-02T22:30:00-05:00",
+                "category": 2,
+            },
+        ]
+    )
+    beta_db["search_index"].update(("emails.db/emails", "1"), {"is_public": 1})
+    beta_db["search_index"].delete(("emails.db/emails", "2"))
+    assert beta_db.execute(
+        "select type, category, is_public, day, count from search_index_summary "
+        "order by type, day, category"
+    ).fetchall() == [
+        ("emails.db/emails", None, 0, None, 1),
+        ("emails.db/emails", None, 1, "2020-08-01", 1),
+        ("emails.db/emails", 2, 0, "2020-08-02", 2),
+        ("github.db/commits", 1, 1, "2020-08-01", 1),
+        ("github.db/commits", 1, 1, "2020-08-02", 1),
+    ]
+    for qs in (
+        "",
+        "type=emails.db%2Femails",
+        "category=1",
+        "is_public=1&timestamp__month=2020-08",
+        "timestamp__date=2020-08-02",
+        "timestamp__year=2019",
+    ):
+        request = Request.fake("/-/beta?" + qs)
+        assert summary_filters(request.args) is not None
+        count, facets = await get_count_and_facets_sql(
+            ds, "beta", request, use_summary=True
+        )
+        expected_count, expected_facets = await get_count_and_facets_sql(
+            ds, "beta", request
+        )
+        assert count == expected_count
+        assert list(facets) == list(expected_facets)
+    # The day is the date as written, whatever the UTC offset
+    response = await ds.client.get("/-/beta.json?timestamp__date=2020-08-02")
+    data = response.json()
+    assert data["count"] == len(data["results"]) == 3
+    # Times are more precise than the summary table
+    assert (
+        summary_filters(Request.fake("/-/beta?timestamp__gte=2020-08-01T12:00").args)
+        is None
+    )
+
+
 @pytest.mark.asyncio
 async def test_fixture(ds):
     client = ds.client
@@ -248,7 +863,7 @@ async def test_plugin_is_installed():
 
 
 @pytest.fixture
-def ds(tmp_path_factory, monkeypatch):
+def ds(tmp_path_factory, monkeypatch, request):
     db_directory = tmp_path_factory.mktemp("dbs")
     monkeypatch.chdir(db_directory)
     github_path = db_directory / "github.db"
@@ -261,8 +876,9 @@ def ds(tmp_path_factory, monkeypatch):
             """
     emails.db:
         emails:
-            display_sql: |-
-                select * from emails where id = :key
+            display_sql_batch: |-
+                select id as key, * from emails
+                where id in (select value from json_each(:keys))
             display: |-
                 <p>Email from {{ display.from_ }}, subject {{ display.subject }}
             sql: |-
@@ -351,8 +967,12 @@ def ds(tmp_path_factory, monkeypatch):
         pk="id",
     )
     index.callback(beta_path, beta_config_path, None, [])
+    metadata = parse_metadata(METADATA)
+    facet_engine = getattr(request, "param", None)
+    if facet_engine:
+        metadata["plugins"]["dogsheep-beta"]["facet_engine"] = facet_engine
     ds = Datasette(
         [str(beta_path), str(github_path), str(emails_path)],
-        metadata=parse_metadata(METADATA),
+        metadata=metadata,
     )
     return ds
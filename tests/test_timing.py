@@ -0,0 +1,33 @@
+from dogsheep_beta.timing import RequestTimer, Stats, histogram, percentile
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([7], 99) == 7
+
+
+def test_stats_rolling_window():
+    stats = Stats(window=3)
+    for ms in (1, 2, 3, 400):
+        stats.add("search", ms / 1000)
+    summary = stats.summary()["search"]
+    assert summary["count"] == 4
+    assert summary["n"] == 3
+    assert summary["max_ms"] == 400
+    assert summary["histogram"]["5"] == 2
+    assert summary["histogram"]["500"] == 1
+
+
+def test_histogram_overflow():
+    assert histogram([10])["+Inf"] == 1
+
+
+def test_server_timing():
+    timer = RequestTimer()
+    timer.add("search", 0.0123)
+    timer.add("render", 0.001)
+    timer.add("render", 0.002)
+    assert timer.server_timing() == "search;dur=12.3, render;dur=3.0"
@@ -0,0 +1,80 @@
+from dogsheep_beta.watch import DatabaseWatcher, run_watcher
+import os
+import sqlite_utils
+import threading
+import time
+
+
+def test_database_watcher(tmp_path):
+    path = str(tmp_path / "dogs.db")
+    watcher = DatabaseWatcher(path)
+    # Missing files are not created
+    assert not watcher.changed()
+    assert not os.path.exists(path)
+    db = sqlite_utils.Database(path)
+    db["dogs"].insert({"id": 1}, pk="id")
+    assert watcher.changed()
+    assert not watcher.changed()
+    db["dogs"].insert({"id": 2})
+    assert watcher.changed()
+    assert not watcher.changed()
+    # Replacing the file, as a fresh download would
+    db.conn.close()
+    replacement = sqlite_utils.Database(str(tmp_path / "new.db"))
+    replacement["dogs"].insert({"id": 1}, pk="id")
+    replacement.conn.close()
+    os.replace(str(tmp_path / "new.db"), path)
+    assert watcher.changed()
+    assert not watcher.changed()
+    watcher.close()
+
+
+def test_run_watcher(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dogs_db = sqlite_utils.Database(tmp_path / "dogs.db")
+    dogs_db["dogs"].insert({"id": 1, "name": "Cleo"}, pk="id")
+    config_path = tmp_path / "config.yml"
+    config_path.write_text(
+        "dogs.db:\n    dogs:\n        since: id\n"
+        "        sql: select id, id as key, name as title from dogs\n",
+        "utf-8",
+    )
+    beta_path = str(tmp_path / "beta.db")
+    events = []
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=run_watcher,
+        args=(beta_path, str(config_path)),
+        kwargs={
+            "interval": 0.01,
+            "debounce": 0.05,
+            "on_index": events.append,
+            "stop": stop,
+        },
+    )
+
+    def wait_for(count):
+        deadline = time.monotonic() + 5
+        while len(events) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(events) == count
+        return events[-1]
+
+    thread.start()
+    try:
+        # Everything is indexed on startup
+        event = wait_for(1)
+        assert event["databases"] == ["dogs.db"]
+        assert event["stats"]["rows"] == 1
+        # Then just the new rows each time the database changes
+        dogs_db["dogs"].insert_all([{"id": 2, "name": "Pancakes"}, {"id": 3}])
+        event = wait_for(2)
+        assert event["stats"]["rows"] == 2
+        beta_db = sqlite_utils.Database(beta_path)
+        assert [r["key"] for r in beta_db["search_index"].search("pancakes")] == ["2"]
+        beta_db.conn.close()
+        time.sleep(0.2)
+        assert len(events) == 2
+    finally:
+        stop.set()
+        thread.join()